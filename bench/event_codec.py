@@ -0,0 +1,83 @@
+"""
+Micro-benchmark of realtime event encoding.
+
+Compares the cost per event of the old path (str() of the dumped dict at
+publish, then ast.literal_eval and the json.dumps done by send_json for every
+subscriber) with the wire format in events.py (encoded once at publish, header
+split once per worker, payload forwarded untouched). Run from the repository
+root:
+
+    python bench/event_codec.py
+"""
+
+import ast
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from beanie.odm.fields import PydanticObjectId
+
+import events
+from models.comment import DBComment
+
+RUNS = 20_000
+
+comment = DBComment.model_construct(
+    id=PydanticObjectId(),
+    content="A fairly ordinary comment of a couple of sentences. " * 4,
+    commenter_id=PydanticObjectId(),
+    reply_to=None,
+    post_id=PydanticObjectId(),
+    forum_id=PydanticObjectId(),
+    created_at=1700000000,
+    modified_at=1700000000,
+    reply_count=0,
+    upvotes=3,
+    downvotes=0,
+)
+
+
+def legacy_encode() -> str:
+    return str(
+        {
+            "event": "COMMENT_NEW",
+            "forum_id": str(comment.forum_id),
+            "post_id": str(comment.post_id),
+            "item": comment.model_dump(mode="json"),
+        }
+    )
+
+
+def wire_encode() -> str:
+    return events.encode("COMMENT_NEW", comment.forum_id, comment.post_id, comment)
+
+
+legacy_message = legacy_encode()
+wire_message = wire_encode()
+
+
+def legacy_deliver() -> str:
+    return json.dumps(ast.literal_eval(legacy_message))
+
+
+def wire_deliver() -> str:
+    return events.decode(wire_message).payload
+
+
+def us(fn) -> float:
+    return min(timeit.repeat(fn, number=RUNS, repeat=5)) / RUNS * 1e6
+
+
+if __name__ == "__main__":
+    assert json.loads(legacy_deliver()) == {
+        k: v for k, v in json.loads(wire_deliver()).items() if k != "v"
+    }
+    print(f"{'path':<8}{'bytes':>7}{'encode us':>11}{'deliver us':>12}")
+    for name, encode, deliver, message in (
+        ("legacy", legacy_encode, legacy_deliver, legacy_message),
+        ("wire", wire_encode, wire_deliver, wire_message),
+    ):
+        print(f"{name:<8}{len(message):>7}{us(encode):>11.2f}{us(deliver):>12.2f}")
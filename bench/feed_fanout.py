@@ -0,0 +1,147 @@
+"""
+Benchmark of home feeds on a synthetic follow graph.
+
+Forum sizes follow a Zipf distribution: users pick the forums they follow in
+proportion to their size, and posts are published in proportion to it too, so
+a few forums have most of the followers and most of the posts. A share of the
+users read their feed, their timelines are built once before publishing.
+
+Feeds live in Redis at REDIS_ENDPOINT:REDIS_PORT, in database BENCH_REDIS_DB
+(15 by default) which is FLUSHED before every run. The database is simulated
+in memory. Run from the repository root, optionally with the number of users:
+
+    python bench/feed_fanout.py [users]
+
+Each mode is a fan-out limit: `hybrid` is FEED_FANOUT_LIMIT, `push` pushes
+every post to every active follower and `pull` merges every forum on read.
+Times are in milliseconds, `timelines` is the timelines a post is pushed to
+and `stored` the thousands of ids kept in Redis lists.
+"""
+
+import asyncio
+import heapq
+import os
+import random
+import sys
+import time
+from itertools import islice
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from redis import asyncio as aioredis
+
+from consts import FEED_FANOUT_LIMIT, FEED_SIZE, FEED_TTL
+from feed import Feeds, page
+
+FORUMS = 2_000
+# Forums followed per user, on average
+FOLLOWS = 20
+# Share of the users reading their feed
+ACTIVE = 0.1
+POSTS = 20_000
+READS = 5_000
+MODES = (("hybrid", FEED_FANOUT_LIMIT), ("push", 1 << 62), ("pull", -1))
+
+rng = random.Random(0)
+weights = [1 / rank for rank in range(1, FORUMS + 1)]
+forums = [f"{forum:024x}" for forum in range(FORUMS)]
+
+
+def percentile(times: List[float], p: float) -> float:
+    return sorted(times)[min(len(times) - 1, int(len(times) * p))] * 1e3
+
+
+class Graph:
+    def __init__(self, users: int):
+        self.follows: Dict[str, List[str]] = {}
+        self.followers: Dict[str, List[str]] = {forum: [] for forum in forums}
+        for user in range(users):
+            user = f"{user:024x}"
+            k = min(FORUMS, int(rng.expovariate(1 / FOLLOWS)) + 1)
+            self.follows[user] = sorted(set(rng.choices(forums, weights, k=k)))
+            for forum in self.follows[user]:
+                self.followers[forum].append(user)
+        self.active = rng.sample(sorted(self.follows), int(users * ACTIVE))
+        # Post ids increase like ObjectIds, ahead of the users and forums
+        self.posts = [
+            (f"{(1 << 80) + post:024x}", forum)
+            for post, forum in enumerate(rng.choices(forums, weights, k=POSTS))
+        ]
+        self.published: Dict[str, List[str]] = {forum: [] for forum in forums}
+
+    async def load(self, forums: List[str]) -> List[str]:
+        latest = [reversed(self.published[forum][-FEED_SIZE:]) for forum in forums]
+        return [*islice(heapq.merge(*latest, reverse=True), FEED_SIZE)]
+
+
+async def run(redis: aioredis.Redis, graph: Graph, fanout_limit: int) -> Dict:
+    await redis.flushdb()
+    feeds = Feeds(redis, size=FEED_SIZE, fanout_limit=fanout_limit, ttl=FEED_TTL)
+    for forum, followers in graph.followers.items():
+        await feeds.resize(forum, len(followers))
+    for forums in graph.published.values():
+        forums.clear()
+    for user in graph.active:
+        await feeds.read(user, graph.follows[user], graph.load)
+
+    active = set(graph.active)
+    pushes, pushed = [], 0
+    for post, forum in graph.posts:
+        graph.published[forum].append(post)
+        followers = []
+        if not feeds.large(len(graph.followers[forum])):
+            followers = graph.followers[forum]
+            # Inactive timelines don't exist, LPUSHX skips them
+            pushed += sum(user in active for user in followers)
+        start = time.perf_counter()
+        await feeds.push(post, forum, followers)
+        pushes.append(time.perf_counter() - start)
+
+    reads = []
+    for user in rng.choices(graph.active, k=READS):
+        start = time.perf_counter()
+        ids = await feeds.read(user, graph.follows[user], graph.load)
+        page(ids, None, 10)
+        reads.append(time.perf_counter() - start)
+    stored = 0
+    async for key in redis.scan_iter(match="feed:*:*"):
+        stored += await redis.llen(key)
+    return {
+        "push": sum(pushes) / len(pushes) * 1e3,
+        "push p99": percentile(pushes, 0.99),
+        "timelines": pushed / len(graph.posts),
+        "read p50": percentile(reads, 0.5),
+        "read p99": percentile(reads, 0.99),
+        "read max": max(reads) * 1e3,
+        "stored k": stored / 1e3,
+    }
+
+
+async def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    graph = Graph(users)
+    sizes = sorted(map(len, graph.followers.values()), reverse=True)
+    print(
+        f"{users} users, {len(graph.active)} active, {FORUMS} forums, "
+        f"largest {sizes[:3]}, {sum(size > FEED_FANOUT_LIMIT for size in sizes)} "
+        f"over the fan-out limit of {FEED_FANOUT_LIMIT}"
+    )
+    redis = aioredis.Redis(
+        host=os.getenv("REDIS_ENDPOINT", "localhost"),
+        port=int(os.getenv("REDIS_PORT", 6379)),
+        db=int(os.getenv("BENCH_REDIS_DB", 15)),
+    )
+    columns = None
+    for mode, fanout_limit in MODES:
+        result = await run(redis, graph, fanout_limit)
+        if columns is None:
+            columns = [*result]
+            print(f"{'mode':<8}" + "".join(f"{column:>11}" for column in columns))
+        print(f"{mode:<8}" + "".join(f"{result[c]:>11.2f}" for c in columns))
+    await redis.flushdb()
+    await redis.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
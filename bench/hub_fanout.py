@@ -0,0 +1,132 @@
+"""
+Load test for the realtime fan-out hub.
+
+Opens N fake connections on an in-memory broadcast, publishes events to one
+forum and reports CPU time per delivered event. Run from the repository root:
+
+    python bench/hub_fanout.py
+
+`interested` keeps a fixed number of followers while the idle connection count
+grows, `everyone` makes every connection a follower. The `legacy` rows give
+each connection its own broadcast subscription and decode, like the websocket
+handler did before the hub. They stop at 1,000 connections, beyond that they
+take minutes.
+"""
+
+import ast
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from broadcaster import Broadcast
+from pydantic import BaseModel
+
+import events
+from hub import Hub, forum_channel
+
+EVENTS = 200
+FOLLOWERS = 100
+SIZES = (100, 1_000, 10_000)
+
+
+class Item(BaseModel):
+    id: str
+    content: str
+    commenter_id: str
+
+
+ITEM = {"id": "0" * 24, "content": "x" * 200, "commenter_id": "0" * 24}
+MESSAGE = events.encode("COMMENT_NEW", "hot", "post", Item(**ITEM))
+LEGACY_MESSAGE = str(
+    {"event": "COMMENT_NEW", "forum_id": "hot", "post_id": "post", "item": ITEM}
+)
+
+
+class FakeConnection:
+    def __init__(self, forum: str, done: asyncio.Event, expected: list):
+        self.topics = SimpleNamespace(forums={forum}, posts={}, events={"COMMENT_NEW"})
+        self.done = done
+        self.expected = expected
+
+    def send(self, event: events.Event):
+        self.expected[0] -= 1
+        if not self.expected[0]:
+            self.done.set()
+
+
+async def publish_all(broadcast: Broadcast, done: asyncio.Event) -> float:
+    await asyncio.sleep(0.1)
+    start = time.process_time()
+    for _ in range(EVENTS):
+        await broadcast.publish(channel=forum_channel("hot"), message=MESSAGE)
+    await done.wait()
+    return time.process_time() - start
+
+
+async def run_hub(total: int, followers: int) -> float:
+    broadcast = Broadcast("memory://")
+    await broadcast.connect()
+    hub = Hub(broadcast)
+    done = asyncio.Event()
+    expected = [followers * EVENTS]
+    for i in range(total):
+        forum = "hot" if i < followers else f"idle-{i % 500}"
+        hub.sync(FakeConnection(forum, done, expected))
+    cpu = await publish_all(broadcast, done)
+    hub.close()
+    await broadcast.disconnect()
+    return cpu
+
+
+async def run_legacy(total: int, followers: int) -> float:
+    broadcast = Broadcast("memory://")
+    await broadcast.connect()
+    done = asyncio.Event()
+    expected = [followers * EVENTS]
+
+    async def connection(forum: str):
+        async with broadcast.subscribe(channel="f") as subscriber:
+            async for event in subscriber:
+                msg = ast.literal_eval(event.message)
+                if msg["forum_id"] == forum:
+                    expected[0] -= 1
+                    if not expected[0]:
+                        done.set()
+
+    tasks = [
+        asyncio.create_task(connection("hot" if i < followers else f"idle-{i}"))
+        for i in range(total)
+    ]
+    await asyncio.sleep(0.1)
+    start = time.process_time()
+    for _ in range(EVENTS):
+        await broadcast.publish(channel="f", message=LEGACY_MESSAGE)
+    await done.wait()
+    cpu = time.process_time() - start
+    for task in tasks:
+        task.cancel()
+    await broadcast.disconnect()
+    return cpu
+
+
+async def main():
+    print(f"{'mode':<12}{'connections':>12}{'followers':>11}{'us/delivery':>13}")
+    for total in SIZES:
+        for mode, followers, run in (
+            ("interested", FOLLOWERS, run_hub),
+            ("everyone", total, run_hub),
+            ("legacy", FOLLOWERS, run_legacy),
+        ):
+            if run is run_legacy and total > 1_000:
+                continue
+            cpu = await run(total, followers)
+            per = cpu / (followers * EVENTS) * 1e6
+            print(f"{mode:<12}{total:>12}{followers:>11}{per:>13.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
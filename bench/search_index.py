@@ -0,0 +1,81 @@
+"""
+Benchmark of the local search index.
+
+Indexes synthetic posts whose words follow a Zipf distribution, like natural
+text, then reports query latency for exact, prefix and misspelled queries.
+Run from the repository root, optionally with the number of posts:
+
+    python bench/search_index.py [posts]
+"""
+
+import os
+import random
+import resource
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search import FIELDS, InvertedIndex
+
+VOCABULARY = 50_000
+QUERIES = 500
+
+rng = random.Random(0)
+words = [
+    "".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 10)))
+    for _ in range(VOCABULARY)
+]
+# Texts are slices of one long Zipf distributed word stream, drawing every
+# text separately would take longer than indexing it
+stream = rng.choices(words, [1 / rank for rank in range(1, VOCABULARY + 1)], k=10**6)
+
+
+def text(n: int) -> str:
+    start = rng.randrange(len(stream) - n)
+    return " ".join(stream[start : start + n])
+
+
+def typo(word: str) -> str:
+    i = rng.randrange(len(word))
+    return word[:i] + rng.choice(string.ascii_lowercase) + word[i + 1 :]
+
+
+def queries(kind: str):
+    for _ in range(QUERIES):
+        picked = rng.choices(words[100:], k=rng.randint(1, 3))
+        if kind == "prefix":
+            picked[-1] = picked[-1][:3]
+        elif kind == "typo":
+            picked = [typo(word) if len(word) >= 4 else word for word in picked]
+        elif kind == "common":
+            picked.append(rng.choice(words[:10]))
+        yield " ".join(picked)
+
+
+def percentile(samples, p: float) -> float:
+    return sorted(samples)[int(len(samples) * p) - 1]
+
+
+if __name__ == "__main__":
+    posts = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    index = InvertedIndex(FIELDS["posts"])
+    start = time.perf_counter()
+    for i in range(posts):
+        index.add(f"{i:024x}", {"title": text(8), "content": text(60)})
+    built = time.perf_counter() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{posts} posts, {len(index.postings)} terms")
+    print(f"indexed in {built:.1f}s ({posts / built:.0f} posts/s), max rss {rss:.0f}mb")
+    print(f"{'query':<8}{'p50 ms':>8}{'p99 ms':>8}{'max ms':>8}")
+    for kind in ("exact", "prefix", "typo", "common"):
+        samples = []
+        for query in queries(kind):
+            start = time.perf_counter()
+            index.search(query, 1000)
+            samples.append((time.perf_counter() - start) * 1000)
+        print(
+            f"{kind:<8}{percentile(samples, 0.5):>8.2f}"
+            f"{percentile(samples, 0.99):>8.2f}{max(samples):>8.2f}"
+        )
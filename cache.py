@@ -0,0 +1,167 @@
+import asyncio
+import json
+from collections import OrderedDict
+from hashlib import sha256
+from time import monotonic
+from typing import Any, Awaitable, Callable, Hashable, Iterable, Optional
+
+from aiocache import Cache
+from beanie import Document
+from broadcaster import Broadcast
+from redis import asyncio as aioredis
+
+import metrics
+
+
+class LRUCache:
+    """
+    Size bounded in-process cache with an optional per entry ttl. Hits, misses
+    and evictions are reported under `name`.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: Optional[float] = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        metrics.gauge(f"{name}.size", lambda: len(self._data))
+
+    def get(self, key: Hashable) -> Any:
+        try:
+            expires, value = self._data[key]
+        except KeyError:
+            metrics.inc(f"{self.name}.misses")
+            return None
+        if expires and expires < monotonic():
+            del self._data[key]
+            metrics.inc(f"{self.name}.misses")
+            return None
+        self._data.move_to_end(key)
+        metrics.inc(f"{self.name}.hits")
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self._data[key] = (monotonic() + self.ttl if self.ttl else None, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            metrics.inc(f"{self.name}.evictions")
+
+    def pop(self, key: Hashable):
+        self._data.pop(key, None)
+
+
+class EntityCache:
+    """
+    Read-through cache for single entity lookups. Entries live in a local LRU
+    backed by Redis, and are dropped from both tiers on every worker through
+    the broadcast channel when `invalidate` is called.
+
+    Entries are keyed by `(kind, field, value)`, like `("user", "id", id)` or
+    `("user", "username", username)`.
+    """
+
+    CHANNEL = "invalidate"
+
+    def __init__(
+        self,
+        remote: Cache,
+        broadcast: Broadcast,
+        maxsize: int,
+        ttl: Optional[float] = None,
+    ):
+        self.local = LRUCache("entities", maxsize, ttl)
+        self.remote = remote
+        self.broadcast = broadcast
+
+    @staticmethod
+    def key(kind: str, field: str, value: Any) -> str:
+        return f"{kind}:{field}:{value}"
+
+    async def get(
+        self,
+        kind: str,
+        field: str,
+        value: Any,
+        load: Callable[[], Awaitable[Optional[Document]]],
+    ) -> Any:
+        """
+        Returns the cached gql object, calling `load` for the document on a miss.
+        Missing documents are not cached.
+        """
+        key = self.key(kind, field, value)
+        item = self.local.get(key)
+        if item is not None:
+            return item
+        item = await self.remote.get(key)
+        if item is None:
+            metrics.inc("entities.remote_misses")
+            doc = await load()
+            if not doc:
+                return None
+            item = doc.gql()
+            await self.remote.set(key, item)
+        else:
+            metrics.inc("entities.remote_hits")
+        self.local.set(key, item)
+        return item
+
+    async def invalidate(self, kind: str, **fields: Any):
+        keys = [self.key(kind, field, value) for field, value in fields.items()]
+        for key in keys:
+            self.local.pop(key)
+        await asyncio.gather(*map(self.remote.delete, keys))
+        await self.broadcast.publish(channel=self.CHANNEL, message=json.dumps(keys))
+
+    async def listen(self):
+        """Drops local entries invalidated by other workers. Runs for the app lifetime."""
+        await evict_on_broadcast(self.broadcast, self.CHANNEL, self.local)
+
+
+class ResponseCache:
+    """
+    Shared cache of rendered GraphQL responses, tagged with what they show like
+    `forum:<id>` or `post:<id>`. Purging tags drops every response carrying one
+    of them, and every response tagged `all` as it may show anything.
+    """
+
+    ALL = "all"
+
+    def __init__(self, redis: aioredis.Redis, ttl: int):
+        self.redis = redis
+        self.ttl = ttl
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        return sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    async def get(self, key: str) -> Optional[bytes]:
+        body = await self.redis.get(f"response:{key}")
+        metrics.inc("responses.hits" if body is not None else "responses.misses")
+        return body
+
+    async def set(self, key: str, body: bytes, tags: Iterable[str]):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.set(f"response:{key}", body, ex=self.ttl)
+            for tag in tags:
+                pipe.sadd(f"response_tag:{tag}", key)
+                pipe.expire(f"response_tag:{tag}", self.ttl)
+            await pipe.execute()
+
+    async def purge(self, *tags: str):
+        tags = [f"response_tag:{tag}" for tag in (*tags, self.ALL)]
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for tag in tags:
+                pipe.smembers(tag)
+            members = await pipe.execute()
+        keys = {f"response:{key.decode()}" for keys in members for key in keys}
+        await self.redis.delete(*keys, *tags)
+        metrics.inc("responses.purged", len(keys))
+
+
+async def evict_on_broadcast(broadcast: Broadcast, channel: str, cache: LRUCache):
+    """Pops every key in the JSON lists published on `channel` from `cache`."""
+    async with broadcast.subscribe(channel=channel) as subscriber:
+        async for event in subscriber:
+            for key in json.loads(event.message):
+                cache.pop(key)
@@ -0,0 +1,290 @@
+"""
+Serving of uploaded files under CDN_ROUTE.
+
+Every stored file is immutable, its path contains either the content digest or
+an ObjectId, so responses may be cached forever by browsers and reverse
+proxies. Responses carry strong ETags, answer conditional requests with 304 and
+single byte ranges with 206 so videos can be seeked.
+
+Uploads in progress are written under tmp/ of the same storage, they are never
+served.
+"""
+
+import mimetypes
+import os
+import re
+from abc import ABC, abstractmethod
+from email.utils import formatdate, parsedate_to_datetime
+from typing import AsyncIterator, Callable, Dict, Optional, Tuple
+
+import anyio
+from opendal import AsyncOperator
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import PlainTextResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Receive, Scope, Send
+
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+CHUNK_SIZE = 256 * 1024
+# Directory of partial uploads, see gql/files.py
+PRIVATE = "tmp"
+# blobs/ab/<digest>.png and variants/ab/<digest>-small.webp
+CONTENT_ADDRESSED = re.compile(
+    r"(?:^|/)(?:blobs|variants)/[0-9a-f]{2}/([0-9a-f]{64}(?:-[a-z]+)?)\.?[^/]*$"
+)
+
+
+def digest_etag(path: str) -> Optional[str]:
+    match = CONTENT_ADDRESSED.search(str(path))
+    return f'"{match.group(1)}"' if match else None
+
+
+def private(path: str) -> bool:
+    """Whether a normalized path relative to the storage root must not be served."""
+    return path.split(os.sep, 1)[0] == PRIVATE
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parses a single `bytes=` range into inclusive offsets. Returns None when the
+    header should be ignored and raises ValueError when it can't be satisfied.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep or not (first + last).isdigit():
+        return None
+    if not first:
+        if int(last) == 0 or size == 0:
+            raise ValueError
+        return max(size - int(last), 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError
+    return start, end
+
+
+def matches(header: str, etag: str) -> bool:
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or etag in tags
+
+
+class SliceResponse(Response, ABC):
+    """Sends `length` bytes of a file starting at `offset`."""
+
+    def __init__(
+        self,
+        offset: int,
+        length: int,
+        status_code: int,
+        headers: Dict[str, str],
+        method: str,
+    ):
+        self.offset = offset
+        self.length = length
+        self.method = method
+        super().__init__(status_code=status_code, headers=headers)
+
+    @abstractmethod
+    def chunks(self) -> AsyncIterator[bytes]:
+        """The `length` bytes from `offset`, in chunks."""
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        if self.method == "HEAD" or not self.length:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        await self.send_body(scope, send)
+
+    async def send_body(self, scope: Scope, send: Send):
+        async for chunk in self.chunks():
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+
+class FileSlice(SliceResponse):
+    def __init__(self, path: str, *args, **kwargs):
+        self.path = path
+        super().__init__(*args, **kwargs)
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        async with await anyio.open_file(self.path, "rb") as f:
+            await f.seek(self.offset)
+            remaining = self.length
+            while remaining > 0:
+                chunk = await f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+
+    async def send_body(self, scope: Scope, send: Send):
+        if "http.response.zerocopysend" not in scope.get("extensions", {}):
+            await super().send_body(scope, send)
+            return
+        # The server copies from the file to the socket in the kernel (sendfile)
+        with open(self.path, "rb") as f:
+            await send(
+                {
+                    "type": "http.response.zerocopysend",
+                    "file": f,
+                    "offset": self.offset,
+                    "count": self.length,
+                }
+            )
+
+
+class OperatorSlice(SliceResponse):
+    def __init__(self, operator: AsyncOperator, path: str, *args, **kwargs):
+        self.operator = operator
+        self.path = path
+        super().__init__(*args, **kwargs)
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        reader = await self.operator.open(self.path, "rb")
+        try:
+            await reader.seek(self.offset)
+            remaining = self.length
+            while remaining > 0:
+                chunk = bytes(await reader.read(min(CHUNK_SIZE, remaining)))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            await reader.close()
+
+
+def respond(
+    scope: Scope,
+    path: str,
+    size: int,
+    etag: Optional[str],
+    last_modified: Optional[float],
+    body: Callable[..., SliceResponse],
+) -> Response:
+    """
+    Builds the response for a stored file, `body(offset, length, status_code,
+    headers, method)` creates the response sending the file's bytes.
+    """
+    request = Headers(scope=scope)
+    headers = {"accept-ranges": "bytes", "cache-control": CACHE_CONTROL}
+    if etag:
+        headers["etag"] = etag
+    if last_modified is not None:
+        headers["last-modified"] = formatdate(last_modified, usegmt=True)
+    headers["content-type"] = (
+        mimetypes.guess_type(path)[0] or "application/octet-stream"
+    )
+
+    if etag and "if-none-match" in request:
+        if matches(request["if-none-match"], etag):
+            return NotModifiedResponse(Headers(headers))
+    elif last_modified is not None and "if-modified-since" in request:
+        try:
+            since = parsedate_to_datetime(request["if-modified-since"]).timestamp()
+        except (TypeError, ValueError):
+            since = None
+        if since is not None and int(last_modified) <= since:
+            return NotModifiedResponse(Headers(headers))
+
+    if_range = request.get("if-range")
+    if "range" in request and (if_range is None or (etag and if_range == etag)):
+        try:
+            span = parse_range(request["range"], size)
+        except ValueError:
+            return PlainTextResponse(
+                "Range Not Satisfiable",
+                status_code=416,
+                headers={"content-range": f"bytes */{size}"},
+            )
+        if span:
+            start, end = span
+            headers["content-range"] = f"bytes {start}-{end}/{size}"
+            headers["content-length"] = str(end - start + 1)
+            return body(start, end - start + 1, 206, headers, scope["method"])
+
+    headers["content-length"] = str(size)
+    return body(0, size, 200, headers, scope["method"])
+
+
+class CDNFiles(StaticFiles):
+    """StaticFiles serving immutable uploads from the local file system."""
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        if private(path):
+            raise HTTPException(status_code=404)
+        return await super().get_response(path, scope)
+
+    def file_response(
+        self,
+        full_path: str,
+        stat_result: os.stat_result,
+        scope: Scope,
+        status_code: int = 200,
+    ) -> Response:
+        st = stat_result
+        etag = digest_etag(full_path) or (
+            f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+        )
+        return respond(
+            scope,
+            full_path,
+            st.st_size,
+            etag,
+            st.st_mtime,
+            lambda *args: FileSlice(full_path, *args),
+        )
+
+
+class OperatorFiles:
+    """
+    Serves immutable uploads from an opendal operator, for storage backends
+    other than the local file system.
+    """
+
+    def __init__(self, operator: AsyncOperator):
+        self.operator = operator
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        assert scope["type"] == "http"
+        response = await self.get_response(scope)
+        await response(scope, receive, send)
+
+    async def get_response(self, scope: Scope) -> Response:
+        if scope["method"] not in ("GET", "HEAD"):
+            return PlainTextResponse("Method Not Allowed", status_code=405)
+        path = os.path.normpath(scope["path"].lstrip("/"))
+        if path.startswith("..") or path == "." or private(path):
+            return PlainTextResponse("Not Found", status_code=404)
+        try:
+            meta = await self.operator.stat(path)
+        except Exception:
+            return PlainTextResponse("Not Found", status_code=404)
+        if meta.mode.is_dir():
+            return PlainTextResponse("Not Found", status_code=404)
+        etag = digest_etag(path) or meta.etag
+        return respond(
+            scope,
+            path,
+            meta.content_length,
+            etag,
+            None,
+            lambda *args: OperatorSlice(self.operator, path, *args),
+        )
+
+
+def cdn_app(operator: AsyncOperator, directory: str):
+    """Picks the backend named by CDN_BACKEND, `fs` (default) or `opendal`."""
+    if os.getenv("CDN_BACKEND", "fs") == "opendal":
+        return OperatorFiles(operator)
+    return CDNFiles(directory=directory)
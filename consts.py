@@ -1,4 +1,6 @@
 MAX_FILE_SIZE = 32 * 1024 * 1024  # 32mb
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1mb read from the upload and written at a time
+UPLOAD_CONCURRENCY = 3  # files of one request stored at the same time
 CDN_ROUTE = "/cdn"
 ORIGINS = [
     "http://localhost:5173",  # Local frontend
@@ -7,3 +9,25 @@ ORIGINS = [
 MAX_SESSIONS = 5
 RTE_URL = "ws://localhost:3758/rte/v1/"
 VC_URL = "ws://localhost:3001/ws"
+ENTITY_CACHE_SIZE = 10_000  # entries per worker
+ENTITY_CACHE_TTL = 60  # seconds an entry may live in a worker
+SESSION_CACHE_SIZE = 10_000  # sessions per worker
+SESSION_CACHE_TTL = 5  # seconds a worker trusts a session without asking redis
+DOCUMENT_CACHE_SIZE = 1000  # parsed and validated queries per worker
+PERSISTED_QUERY_CACHE_SIZE = 1000  # persisted query texts per worker
+PERSISTED_QUERY_TTL = 7 * 24 * 60 * 60  # seconds a query registered by a client is kept
+RTE_QUEUE_SIZE = 256  # events buffered per realtime client
+RTE_QUEUE_POLICY = "coalesce"  # drop_oldest, coalesce or disconnect
+RTE_MAX_TOPICS = 100  # forums and posts one realtime client may follow
+COMMENT_TREE_MAX_DEPTH = 8  # levels of replies one comment tree query may load
+COMMENT_TREE_MAX_NODES = 500  # comments one comment tree query may load
+MAX_QUERY_COST = 2000  # documents and lookups one operation may ask for
+MAX_QUERY_DEPTH = 12  # nested selections of an operation, a full comment tree needs 12
+RESPONSE_CACHE_TTL = 60  # seconds a shared response is kept unless purged earlier
+RESPONSE_MAX_AGE = 5  # seconds proxies and browsers may reuse a shared response
+RANKING_SIZE = 1000  # best posts kept in each hot and top ranking
+FEED_SIZE = 500  # latest posts kept in a home feed timeline or forum list
+FEED_FANOUT_LIMIT = 1000  # followers up to which new posts are pushed to their feeds
+FEED_TTL = 2 * 24 * 60 * 60  # seconds a timeline is kept after its last read
+SEARCH_MAX_HITS = 1000  # best matches of a local search that are paged
+SEARCH_MAX_FILTERED_HITS = 20_000  # best matches of a local search with filters
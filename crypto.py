@@ -0,0 +1,44 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable
+
+import metrics
+
+
+class CryptoPool:
+    """
+    Runs CPU heavy hashing and encryption (Argon2, Scrypt, Fernet) on worker
+    threads so they don't block the event loop. At most `max_concurrency` calls
+    are handed to the pool at once, the rest wait on the event loop and are
+    reported as the `crypto.queue_depth` gauge.
+    """
+
+    def __init__(self, workers: int, max_concurrency: int):
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="crypto"
+        )
+        self.limit = asyncio.Semaphore(max_concurrency)
+        self.waiting = 0
+        self.running = 0
+        metrics.gauge("crypto.queue_depth", lambda: self.waiting)
+        metrics.gauge("crypto.running", lambda: self.running)
+
+    async def run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        self.waiting += 1
+        try:
+            await self.limit.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        try:
+            metrics.inc("crypto.calls")
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, partial(fn, *args, **kwargs)
+            )
+        finally:
+            self.running -= 1
+            self.limit.release()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -73,6 +73,7 @@ class PostCreationErrorType(Enum):
     LOCKED_FORUM = 1
     INVALID_POLL = 2
     BANNED_MEMBER = 3
+    INVALID_ATTACHMENT = 4
 
 
 @strawberry.type
@@ -118,3 +119,70 @@ class FileUploadError(Exception):
 
     def into(self) -> GraphQLError:
         return GraphQLError(self.msg, extensions={"tp": self.tp.name})
+
+
+@strawberry.enum
+class VoteErrorType(Enum):
+    TARGET_NOT_FOUND = 0
+    BANNED_MEMBER = 1
+
+
+@strawberry.type
+class VoteError(Exception):
+    def __init__(self, *args, tp: VoteErrorType):
+        super().__init__(*args)
+        self.msg = args[0]
+        self.tp = tp
+
+    def into(self) -> GraphQLError:
+        return GraphQLError(self.msg, extensions={"tp": self.tp.name})
+
+
+@strawberry.enum
+class FollowErrorType(Enum):
+    FORUM_NOT_FOUND = 0
+
+
+@strawberry.type
+class FollowError(Exception):
+    def __init__(self, *args, tp: FollowErrorType):
+        super().__init__(*args)
+        self.msg = args[0]
+        self.tp = tp
+
+    def into(self) -> GraphQLError:
+        return GraphQLError(self.msg, extensions={"tp": self.tp.name})
+
+
+@strawberry.enum
+class PersistedQueryErrorType(Enum):
+    PERSISTED_QUERY_NOT_FOUND = 0
+    PERSISTED_QUERY_NOT_ALLOWED = 1
+    PROVIDED_SHA_DOES_NOT_MATCH = 2
+
+
+@strawberry.type
+class PersistedQueryError(Exception):
+    def __init__(self, *args, tp: PersistedQueryErrorType):
+        super().__init__(*args)
+        self.msg = args[0]
+        self.tp = tp
+
+    def into(self) -> GraphQLError:
+        # Clients implementing the protocol look for `code`
+        return GraphQLError(
+            self.msg, extensions={"tp": self.tp.name, "code": self.tp.name}
+        )
+
+
+@strawberry.type
+class QueryTooExpensive(Exception):
+    def __init__(self, cost: int):
+        super().__init__()
+        self.cost = cost
+
+    def gql(self) -> GraphQLError:
+        return GraphQLError(
+            "Query is too expensive, request fewer items or fields",
+            extensions={"tp": "QUERY_TOO_EXPENSIVE", "cost": self.cost},
+        )
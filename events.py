@@ -0,0 +1,43 @@
+"""
+Wire format of realtime events.
+
+An event is encoded once when it is published, as a routing header line
+followed by the JSON payload that is sent to websocket clients as is:
+
+    1 COMMENT_NEW <forum_id> <post_id> <item_id>
+    {"v":1,"event":"COMMENT_NEW","forum_id":"...","post_id":"...","item":{...}}
+
+Workers only split the header to route an event and never parse or re-encode
+the payload. Bump VERSION on any incompatible change to either part.
+"""
+
+from typing import NamedTuple
+
+from pydantic import BaseModel
+
+VERSION = 1
+
+
+class Event(NamedTuple):
+    event: str
+    forum_id: str
+    post_id: str
+    item_id: str
+    payload: str
+
+
+def encode(event: str, forum_id, post_id, item: BaseModel) -> str:
+    # Event names and ObjectIds never need escaping
+    payload = (
+        f'{{"v":{VERSION},"event":"{event}","forum_id":"{forum_id}",'
+        f'"post_id":"{post_id}","item":{item.model_dump_json()}}}'
+    )
+    return f"{VERSION} {event} {forum_id} {post_id} {item.id}\n{payload}"
+
+
+def decode(message: str) -> Event:
+    header, payload = message.split("\n", 1)
+    version, *fields = header.split(" ")
+    if version != str(VERSION) or len(fields) != 4:
+        raise ValueError(f"Unsupported event header {header!r}")
+    return Event(*fields, payload)
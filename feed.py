@@ -0,0 +1,168 @@
+"""
+Home feeds, the latest posts of the forums a user follows.
+
+Fan-out is hybrid. A new post of a forum with at most `fanout_limit` followers
+is pushed to the timeline of each of its followers who read their feed
+recently: a Redis list of post ids that expires `ttl` seconds after its last
+read. Posts of larger forums aren't pushed, a feed read merges them in from
+the forum's own list of recent posts. Timelines and forum lists that don't
+exist are rebuilt from the database on read. When a forum stops being large
+the timelines of its followers are dropped, they were built without it.
+
+A list being rebuilt ends with PENDING, so posts pushed while the database is
+read land in it and are merged with what was read.
+
+Post ids are ObjectIds, which order by creation time, so lists are merged by
+comparing ids.
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Iterable, List, Optional, Tuple
+
+from redis import asyncio as aioredis
+
+# Ends every rebuilt list, so an empty feed is still a list Redis keeps
+SENTINEL = "0"
+# Ends a list while it is rebuilt
+PENDING = "?"
+# Latest post ids of forums, from the database
+Loader = Callable[[List[str]], Awaitable[List[str]]]
+
+# KEYS: the list, the large forums. ARGV: size, ttl, the number of large forums
+# left out of the list, those forums and the ids read from the database. "0"
+# and "?" are SENTINEL and PENDING.
+# Nothing is stored when the list was dropped or a forum left out stopped
+# being large while the database was read, the next read rebuilds it.
+REBUILD = """
+local size, ttl, excluded = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local current = redis.call("LRANGE", KEYS[1], 0, -1)
+local stale = #current == 0
+for i = 4, 3 + excluded do
+    stale = stale or redis.call("SISMEMBER", KEYS[2], ARGV[i]) == 0
+end
+local seen, ids = {}, {}
+local function add(id)
+    if id ~= "0" and id ~= "?" and not seen[id] then
+        seen[id] = true
+        ids[#ids + 1] = id
+    end
+end
+for _, id in ipairs(current) do
+    add(id)
+end
+for i = 4 + excluded, #ARGV do
+    add(ARGV[i])
+end
+table.sort(ids, function(a, b) return a > b end)
+while #ids > size do
+    table.remove(ids)
+end
+redis.call("DEL", KEYS[1])
+if stale then
+    return ids
+end
+for _, id in ipairs(ids) do
+    redis.call("RPUSH", KEYS[1], id)
+end
+redis.call("RPUSH", KEYS[1], "0")
+redis.call("EXPIRE", KEYS[1], ttl)
+return ids
+"""
+
+
+class Feeds:
+    LARGE = "feed:large"
+
+    def __init__(self, redis: aioredis.Redis, size: int, fanout_limit: int, ttl: int):
+        self.redis = redis
+        # Posts kept in a timeline or forum list
+        self.size = size
+        self.fanout_limit = fanout_limit
+        self.ttl = ttl
+        self.rebuild_script = redis.register_script(REBUILD)
+
+    @staticmethod
+    def timeline(user_id: str) -> str:
+        return f"feed:user:{user_id}"
+
+    @staticmethod
+    def recent(forum_id: str) -> str:
+        return f"feed:forum:{forum_id}"
+
+    def large(self, follower_count: int) -> bool:
+        return follower_count > self.fanout_limit
+
+    async def resize(self, forum_id: str, follower_count: int) -> bool:
+        """
+        Moves a forum between pushing its posts and merging them on read.
+        True when it stopped being large, its followers' timelines must be dropped.
+        """
+        if self.large(follower_count):
+            await self.redis.sadd(self.LARGE, forum_id)
+            return False
+        return await self.redis.srem(self.LARGE, forum_id) > 0
+
+    async def push(self, post_id: str, forum_id: str, followers: Iterable[str]):
+        """Adds a new post to its forum list and to the timelines of `followers`."""
+        keys = [self.recent(forum_id), *map(self.timeline, followers)]
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                # Only lists being read exist, the others are rebuilt when read
+                pipe.lpushx(key, post_id)
+                pipe.ltrim(key, 0, self.size - 1)
+            await pipe.execute()
+
+    async def drop(self, *user_ids: str):
+        """Drops timelines whose forums changed, they are rebuilt on the next read."""
+        if user_ids:
+            await self.redis.delete(*map(self.timeline, user_ids))
+
+    async def rebuild(
+        self, key: str, forums: List[str], excluded: List[str], load: Loader
+    ) -> List[str]:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.rpush(key, PENDING)
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+        ids = await load(forums)
+        args = [self.size, self.ttl, len(excluded), *excluded, *ids]
+        return await self.rebuild_script(keys=[key, self.LARGE], args=args)
+
+    async def read(self, user_id: str, forums: List[str], load: Loader) -> List[str]:
+        """Every post id of a user's feed, newest first."""
+        timeline = self.timeline(user_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.smembers(self.LARGE)
+            pipe.lrange(timeline, 0, -1)
+            pipe.expire(timeline, self.ttl)
+            large, pushed, _ = await pipe.execute()
+        large = {id.decode() for id in large}
+        merged = [id for id in forums if id in large]
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for id in merged:
+                pipe.lrange(self.recent(id), 0, -1)
+                pipe.expire(self.recent(id), self.ttl)
+            lists = [pushed, *(await pipe.execute())[::2]]
+        rebuilds = []
+        for i, forum_id in enumerate([None, *merged]):
+            if lists[i] and lists[i][-1].decode() != PENDING:
+                continue
+            if forum_id is None:
+                pushing = [id for id in forums if id not in large]
+                rebuild = self.rebuild(timeline, pushing, merged, load)
+            else:
+                rebuild = self.rebuild(self.recent(forum_id), [forum_id], [], load)
+            rebuilds.append(rebuild)
+            lists[i] = []
+        ids = {id.decode() for items in lists for id in items}
+        for items in await asyncio.gather(*rebuilds):
+            ids.update(id.decode() for id in items)
+        ids -= {SENTINEL, PENDING}
+        return sorted(ids, reverse=True)
+
+
+def page(ids: List[str], before: Optional[str], limit: int) -> Tuple[List[str], bool]:
+    """Ids of a feed page older than `before`, and whether more follow."""
+    if before:
+        ids = [id for id in ids if id < before]
+    return ids[:limit], len(ids) > limit
@@ -30,13 +30,15 @@ class PostSort(Enum):
     DOWNVOTES = 4
     MODIFIED_AT_ASC = 5
     MODIFIED_AT_DESC = 6
+    HOT = 7
+    TOP = 8
 
 
 @strawberry.enum
 class CommentSort(Enum):
     CREATED_AT_ASC = 0
     CREATED_AT_DESC = 1
-    PINNED = 2
+    # 2 was PINNED, comments can't be pinned
     UPVOTES = 3
     DOWNVOTES = 4
 
@@ -52,5 +54,7 @@ T = TypeVar("T")
 @strawberry.type
 class Page(Generic[T]):
     total: int
+    estimated: bool = False
     next_page: Optional[int]
+    next_cursor: Optional[str] = None
     items: List[T]
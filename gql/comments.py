@@ -1,16 +1,42 @@
+import asyncio
 from typing import List, Optional
 
 from beanie.odm.fields import PydanticObjectId
 from beanie.operators import In
+from pymongo import ReturnDocument
 from strawberry.types import Info
 
 from auth import authenticated
-from error import CommentCreationError, CommentCreationErrorType
+from consts import COMMENT_TREE_MAX_DEPTH, COMMENT_TREE_MAX_NODES
+from error import (CommentCreationError, CommentCreationErrorType,
+                   InvalidGetQuery)
 from gql import CommentSort, Page
-from models.comment import Comment, DBComment
-from models.forum import DBForum
+from gql.counts import count_total
+from gql.forums import ban_lookup
+from gql.pagination import next_cursor, paginate, sort_keys
+from gql.selection import COMMENT_FIELDS, projection, selected
+from gql.subscriptions import publish
+from models.comment import Comment, CommentNode, DBComment
 from models.post import DBPost
-from models.user import DBUser
+from ranking import PROJECTION
+
+SORT_KEYS = {
+    CommentSort.CREATED_AT_ASC: [("created_at", 1)],
+    CommentSort.CREATED_AT_DESC: [("created_at", -1)],
+    CommentSort.UPVOTES: [("upvotes", -1)],
+    CommentSort.DOWNVOTES: [("downvotes", -1)],
+}
+
+
+async def count_comment(info: Info, post_id: PydanticObjectId):
+    post = await DBPost.get_motor_collection().find_one_and_update(
+        {"_id": post_id},
+        {"$inc": {"comment_count": 1}},
+        projection=PROJECTION,
+        return_document=ReturnDocument.AFTER,
+    )
+    if post:
+        await info.context.rankings.update(post)
 
 
 @authenticated()
@@ -21,52 +47,75 @@ async def create_commment(
     reply_to: Optional[str] = None,
 ) -> Comment:
     user = await info.context.user()
-    post = await DBPost.find_one(DBPost.id == PydanticObjectId(post_id))
+    user_id = PydanticObjectId(user.id)
+    lookups = [ban_lookup(DBPost, post_id, user_id)]
+    if reply_to:
+        lookups.append(
+            DBComment.get_motor_collection().find_one(
+                {"_id": PydanticObjectId(reply_to)}, {"_id": 1}
+            )
+        )
+    post, *parent = await asyncio.gather(*lookups)
     if not post:
         raise CommentCreationError(
             "Post does not exist",
             tp=CommentCreationErrorType.POST_NOT_FOUND,
         )
-    # Its fine because a post can't exist without a forum
-    # type: ignore
-    forum: DBForum = await DBForum.find_one(DBForum.id == post.forum_id)
-    # TODO: Do this @ban check in query
-    if user.id in forum.banned_members:
+    if post["banned"]:
         raise CommentCreationError(
             "You are banned in this forum",
             tp=CommentCreationErrorType.BANNED_MEMBER,
         )
-
-    if reply_to:
-        parent = await DBComment.find_one(DBComment.id == PydanticObjectId(reply_to))
-        if not parent:
-            raise CommentCreationError(
-                "Parent comment does not exist",
-                tp=CommentCreationErrorType.PARENT_NOT_FOUND,
-            )
-        parent.reply_count += 1
-        await parent.save()
-    comment = DBComment(
+    if reply_to and not parent[0]:
+        raise CommentCreationError(
+            "Parent comment does not exist",
+            tp=CommentCreationErrorType.PARENT_NOT_FOUND,
+        )
+    comment = await DBComment(
         content=content,
-        commenter_id=user.id,
+        commenter_id=user_id,
         reply_to=PydanticObjectId(reply_to) if reply_to else None,
-        post_id=post.id,
-        forum_id=forum.id,
-    )
-    comment.commenter = await DBUser.get(user.id)
-    post.comment_count += 1
-    await post.save()
-    await comment.insert()
-    await info.context.broadcast.publish(
-        channel="f".format(forum.id),
-        message=str({"item": comment.model_dump(), "event": "COMMENT_NEW"}),
-    )
+        post_id=post["_id"],
+        forum_id=post["forum_id"],
+    ).insert()
+    counters = [
+        count_comment(info, post["_id"]),
+    ]
+    if reply_to:
+        counters.append(
+            DBComment.find_one(DBComment.id == comment.reply_to).inc(
+                {DBComment.reply_count: 1}
+            )
+        )
+    await asyncio.gather(*counters)
+    # Invalidated once the counters moved, or a concurrent read caches them stale
+    updates = [
+        info.context.responses.purge(
+            f"forum:{post['forum_id']}", f"post:{post['_id']}"
+        ),
+        info.context.entities.invalidate("post", id=post_id),
+        publish(
+            info.context.broadcast,
+            "COMMENT_NEW",
+            post["forum_id"],
+            post["_id"],
+            comment,
+        ),
+        info.context.search.add("comments", comment),
+    ]
+    if reply_to:
+        updates.append(info.context.entities.invalidate("comment", id=reply_to))
+    await asyncio.gather(*updates)
     return comment.gql()
 
 
-async def get_comment(id: str) -> Optional[Comment]:
-    comment = await DBComment.find_one(DBComment.id == PydanticObjectId(id))
-    return comment.gql() if comment else None
+async def get_comment(info: Info, id: str) -> Optional[Comment]:
+    return await info.context.entities.get(
+        "comment",
+        "id",
+        id,
+        lambda: DBComment.find_one(DBComment.id == PydanticObjectId(id)),
+    )
 
 
 async def get_comments(
@@ -76,81 +125,153 @@ async def get_comments(
     post_id: Optional[str] = None,
     reply_to: Optional[str] = None,
     parent: Optional[bool] = None,
+    search: Optional[str] = None,
     created_after: Optional[int] = None,
     created_before: Optional[int] = None,
     sort: Optional[CommentSort] = None,
     page: int = 1,
     limit: int = 10,
+    cursor: Optional[str] = None,
+    estimate_total: bool = False,
 ) -> Page[Comment]:
     aggregation_pipe = []
     if ids:
         ids = [*map(PydanticObjectId, ids)]
-        comments = DBComment.find(In(DBComment.id, ids), fetch_links=True)
+        comments = DBComment.find(In(DBComment.id, ids))
     elif commenter_id:
         comments = DBComment.find(
-            DBComment.commenter_id == PydanticObjectId(commenter_id), fetch_links=True
+            DBComment.commenter_id == PydanticObjectId(commenter_id)
         )
     elif post_id:
-        comments = DBComment.find(
-            DBComment.post_id == PydanticObjectId(post_id), fetch_links=True
-        )
+        comments = DBComment.find(DBComment.post_id == PydanticObjectId(post_id))
     elif reply_to:
-        comments = DBComment.find(
-            DBComment.reply_to == PydanticObjectId(reply_to), fetch_links=True
-        )
+        comments = DBComment.find(DBComment.reply_to == PydanticObjectId(reply_to))
     else:
-        comments = DBComment.find_all(fetch_links=True)
-    # if search:
-    #     aggregation_pipe.append(
-    #         {
-    #             "$search": {
-    #                 "index": "comments",
-    #                 "text": {
-    #                     "query": search,
-    #                     "path": ["title", "tags", "content", "poll.options"],
-    #                     "fuzzy": {},
-    #                 },
-    #             }
-    #         }
-    #     )
+        comments = DBComment.find_all()
     if isinstance(parent, bool):
         if parent:
-            comments = DBComment.find(DBComment.reply_to == None, fetch_links=True)
+            comments = comments.find(DBComment.reply_to == None)
         else:
-            comments = DBComment.find(DBComment.reply_to != None, fetch_links=True)
+            comments = comments.find(DBComment.reply_to != None)
     if created_after:
         aggregation_pipe.append({"$match": {"created_at": {"$gt": created_after}}})
     if created_before:
         aggregation_pipe.append({"$match": {"created_at": {"$lt": created_before}}})
-    if sort:
-        if sort == CommentSort.CREATED_AT_ASC:
-            aggregation_pipe.append({"$sort": {"created_at": 1}})
-        elif sort == CommentSort.CREATED_AT_DESC:
-            aggregation_pipe.append({"$sort": {"created_at": -1}})
-    total = 0
-    for selection in info.selected_fields:
-        if selection.name == "getComments":
-            for field in selection.selections:
-                if field.name == "total":
-                    p = aggregation_pipe.copy()
-                    p.append({"$count": "total"})
-                    try:
-                        total = (
-                            await comments.aggregate(aggregation_pipeline=p).to_list()
-                        )[0]["total"]
-                    except:
-                        pass
-                    break
-
     page = max(1, page)
     limit = max(min(100, limit), 1)
-    aggregation_pipe.append({"$skip": limit * (page - 1)})
-    aggregation_pipe.append({"$limit": limit})
+    searched = None
+    if search:
+        aggregation_pipe, searched = await info.context.search.stages(
+            "comments", search, comments, aggregation_pipe, 0 if sort else page * limit
+        )
+    keys = None if search and not sort else sort_keys(SORT_KEYS.get(sort, []))
+    maintained = None
+    if not aggregation_pipe and not (ids or commenter_id) and parent is None:
+        if post_id:
+            maintained = (DBPost, post_id, "comment_count")
+        elif reply_to:
+            maintained = (DBComment, reply_to, "reply_count")
+    total, estimated = searched or 0, False
+    if "total" in selected(info) and searched is None:
+        total, estimated = await count_total(
+            info,
+            comments,
+            aggregation_pipe,
+            maintained,
+            estimate=estimate_total,
+        )
+
+    paginate(aggregation_pipe, keys, cursor, page, limit)
+    aggregation_pipe += projection(info, COMMENT_FIELDS, "items")
     comments = comments.aggregate(aggregation_pipe, projection_model=DBComment)
     comments = await comments.to_list()
 
     return Page(
         total=total,
-        next_page=page + 1 if len(comments) == limit else None,
+        estimated=estimated,
+        next_page=page + 1 if len(comments) == limit and not cursor else None,
+        next_cursor=next_cursor(keys, comments, limit),
         items=[*map(DBComment.gql, comments)],
     )
+
+
+def node(comment: DBComment) -> CommentNode:
+    return CommentNode(
+        comment=comment.gql(), replies=[], more_replies=comment.reply_count > 0
+    )
+
+
+async def get_comment_tree(
+    info: Info,
+    post_id: Optional[str] = None,
+    comment_id: Optional[str] = None,
+    depth: int = 3,
+    breadth: int = 10,
+    sort: Optional[List[CommentSort]] = None,
+) -> List[CommentNode]:
+    """
+    The top level comments of a post, or a single comment, with their replies
+    nested `depth` levels deep and at most `breadth` replies per comment.
+    `sort` orders each level, its last entry also applies to deeper levels.
+    Every level is loaded with one query, whatever the number of branches.
+    """
+    depth = max(min(COMMENT_TREE_MAX_DEPTH, depth), 1)
+    breadth = max(min(100, breadth), 1)
+    sort = sort or [None]
+
+    def order(level: int) -> dict:
+        return dict(sort_keys(SORT_KEYS.get(sort[min(level, len(sort) - 1)], [])))
+
+    if comment_id:
+        comments = DBComment.find(DBComment.id == PydanticObjectId(comment_id))
+    elif post_id:
+        comments = DBComment.find(
+            DBComment.post_id == PydanticObjectId(post_id), DBComment.reply_to == None
+        )
+    else:
+        raise InvalidGetQuery().gql()
+    comments = await comments.aggregate(
+        [{"$sort": order(0)}, {"$limit": breadth}], projection_model=DBComment
+    ).to_list()
+    roots = level = [*map(node, comments)]
+    loaded = len(roots)
+
+    for i in range(1, depth):
+        # Only ask for the replies that fit in the node budget
+        parents = [parent for parent in level if parent.comment.reply_count]
+        parents = parents[: (COMMENT_TREE_MAX_NODES - loaded) // breadth]
+        if not parents:
+            break
+        replies = await DBComment.aggregate(
+            [
+                {
+                    "$match": {
+                        "_id": {
+                            "$in": [PydanticObjectId(p.comment.id) for p in parents]
+                        }
+                    }
+                },
+                {
+                    "$lookup": {
+                        "from": DBComment.get_motor_collection().name,
+                        "localField": "_id",
+                        "foreignField": "reply_to",
+                        "pipeline": [{"$sort": order(i)}, {"$limit": breadth}],
+                        "as": "replies",
+                    }
+                },
+                {"$unwind": "$replies"},
+                {"$replaceRoot": {"newRoot": "$replies"}},
+            ],
+            projection_model=DBComment,
+        ).to_list()
+        by_id = {parent.comment.id: parent for parent in parents}
+        level = []
+        for reply in replies:
+            child = node(reply)
+            by_id[str(reply.reply_to)].replies.append(child)
+            level.append(child)
+        for parent in parents:
+            parent.more_replies = parent.comment.reply_count > len(parent.replies)
+        loaded += len(level)
+    return roots
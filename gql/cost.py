@@ -0,0 +1,182 @@
+"""
+Static cost of GraphQL operations, computed before they are executed.
+
+Every root field is a database query costing QUERY_WEIGHT, whatever it
+returns, so aliasing a field many times isn't free, and so is every `total`
+count. Every returned user, forum, post or comment costs one, and so do the
+fields loading something else, like `viewerVote`. Lists are counted at the
+size their `limit` asks for, clamped like their resolver does, comment trees at
+the number of comments they may load. Operations costing more than
+MAX_QUERY_COST are rejected, the cost is reported in the response extensions.
+"""
+
+from typing import Dict, Iterator, Optional
+
+from graphql import (FieldNode, FragmentDefinitionNode, GraphQLError,
+                     GraphQLObjectType, GraphQLSchema, InlineFragmentNode,
+                     SelectionSetNode, get_named_type, get_nullable_type,
+                     is_composite_type, is_list_type)
+from graphql.execution import ExecutionResult
+from graphql.execution.values import get_argument_values
+from graphql.utilities import get_operation_ast
+from strawberry.extensions import SchemaExtension
+
+import metrics
+from consts import (COMMENT_TREE_MAX_DEPTH, COMMENT_TREE_MAX_NODES,
+                    MAX_QUERY_COST)
+from error import QueryTooExpensive
+
+ENTITIES = {"User", "Forum", "Post", "Comment"}
+# A query or count, as much as this many returned documents
+QUERY_WEIGHT = 40
+# Fields costing more, or less, than the default of their type
+COSTS = {
+    "Post.viewerVote": 1,
+    "Comment.viewerVote": 1,
+    "UserPage.total": QUERY_WEIGHT,
+    "ForumPage.total": QUERY_WEIGHT,
+    "PostPage.total": QUERY_WEIGHT,
+    "CommentPage.total": QUERY_WEIGHT,
+    # Unbounded arrays of ids
+    "User.starredBy": 20,
+    "Post.participants": 20,
+    "Poll.participants": 20,
+    "Forum.bannedMembers": 20,
+}
+# Lists of the same nodes as the field above, already counted by its size
+NESTED = {"CommentNode.replies"}
+# Largest `limit` each resolver accepts, and `breadth` for comment trees
+LIMITS = {
+    "getUsers": 20,
+    "getForums": 20,
+    "getPosts": 20,
+    "getComments": 100,
+    "getVoters": 100,
+    "getFeed": 20,
+    "getCommentTree": 100,
+}
+MAX_LIMIT = 100
+
+
+def page_size(name: str, args: Dict) -> Optional[int]:
+    """Items a field asks for in the list below it, the resolvers' clamping."""
+    if "limit" in args:
+        return max(min(LIMITS.get(name, MAX_LIMIT), args["limit"]), 1)
+    if name == "getCommentTree":
+        depth = max(min(COMMENT_TREE_MAX_DEPTH, args["depth"]), 1)
+        breadth = max(min(LIMITS[name], args["breadth"]), 1)
+        nodes = sum(breadth**level for level in range(1, depth + 1))
+        return min(COMMENT_TREE_MAX_NODES, nodes)
+    return None
+
+
+def selection_cost(
+    schema: GraphQLSchema,
+    parent: GraphQLObjectType,
+    selection_set: SelectionSetNode,
+    fragments: Dict[str, FragmentDefinitionNode],
+    variables: Dict,
+    size: Optional[int] = None,
+) -> int:
+    cost = nested = 0
+    for selection in selection_set.selections:
+        if not isinstance(selection, FieldNode):
+            if isinstance(selection, InlineFragmentNode):
+                fragment = selection
+            else:
+                fragment = fragments[selection.name.value]
+            # Fragments count as part of the selection they are spread in
+            condition = fragment.type_condition
+            target = schema.get_type(condition.name.value) if condition else parent
+            cost += selection_cost(
+                schema,
+                target if isinstance(target, GraphQLObjectType) else parent,
+                fragment.selection_set,
+                fragments,
+                variables,
+                size,
+            )
+            continue
+        name = selection.name.value
+        # Introspection never reaches the database
+        if name.startswith("__") or name not in parent.fields:
+            continue
+        field = parent.fields[name]
+        named = get_named_type(field.type)
+        key = f"{parent.name}.{name}"
+        root = parent in (schema.query_type, schema.mutation_type)
+        weight = COSTS.get(key, int(named.name in ENTITIES))
+        args = get_argument_values(field, selection, variables)
+        asked = page_size(name, args)
+        count = 1
+        if is_list_type(get_nullable_type(field.type)):
+            count = asked or size or 1
+            asked = None
+        children = 0
+        if selection.selection_set and is_composite_type(named):
+            children = selection_cost(
+                schema,
+                named if isinstance(named, GraphQLObjectType) else parent,
+                selection.selection_set,
+                fragments,
+                variables,
+                asked,
+            )
+        if key in NESTED:
+            # Every node is counted as the most expensive level
+            nested = max(nested, children)
+        else:
+            # Root fields are one query whatever the number of items
+            cost += QUERY_WEIGHT * root + count * (weight + children)
+    return max(cost, nested)
+
+
+def operation_cost(
+    schema: GraphQLSchema, document, operation_name: Optional[str], variables: Dict
+) -> Optional[int]:
+    """Cost of the operation executed by a request, None if it won't execute."""
+    operation = get_operation_ast(document, operation_name)
+    if operation is None:
+        return None
+    root = schema.get_root_type(operation.operation)
+    fragments = {
+        definition.name.value: definition
+        for definition in document.definitions
+        if isinstance(definition, FragmentDefinitionNode)
+    }
+    try:
+        return selection_cost(
+            schema, root, operation.selection_set, fragments, variables or {}
+        )
+    except GraphQLError:
+        # Invalid variables, reported by the execution
+        return None
+
+
+class QueryCost(SchemaExtension):
+    """Rejects operations costing more than MAX_QUERY_COST."""
+
+    cost: Optional[int] = None
+
+    def on_execute(self) -> Iterator[None]:
+        context = self.execution_context
+        self.cost = operation_cost(
+            context.schema._schema,
+            context.graphql_document,
+            context.operation_name,
+            context.variables,
+        )
+        if self.cost is not None:
+            metrics.inc("query_cost", self.cost)
+            if self.cost > MAX_QUERY_COST:
+                metrics.inc("query_cost.rejected")
+                # Skips the execution
+                context.result = ExecutionResult(
+                    data=None, errors=[QueryTooExpensive(self.cost).gql()]
+                )
+        yield
+
+    def get_results(self) -> Dict:
+        if self.cost is None:
+            return {}
+        return {"cost": {"requested": self.cost, "maximum": MAX_QUERY_COST}}
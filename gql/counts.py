@@ -0,0 +1,85 @@
+import hashlib
+import json
+from typing import Optional, Tuple, Type
+
+from beanie import Document
+from beanie.odm.fields import PydanticObjectId
+from beanie.odm.queries.find import FindMany
+from strawberry.types import Info
+
+
+async def counter(model: Type[Document], id: str, field: str) -> Optional[int]:
+    """
+    Reads a counter maintained on a document. Returns None when the document
+    predates the counter, it is backfilled by the next exact count.
+    """
+    collection = model.get_motor_collection()
+    doc = await collection.find_one({"_id": PydanticObjectId(id)}, {field: 1})
+    if not doc:
+        return 0
+    if field in doc:
+        return doc[field]
+    return None
+
+
+async def backfill(model: Type[Document], id: str, field: str, total: int) -> None:
+    await model.get_motor_collection().update_one(
+        {"_id": PydanticObjectId(id), field: {"$exists": False}},
+        {"$set": {field: total}},
+    )
+
+
+def count_key(query: FindMany, pipe: list) -> str:
+    return hashlib.sha1(
+        json.dumps(
+            [
+                query.document_model.get_collection_name(),
+                query.get_filter_query(),
+                pipe,
+            ],
+            default=str,
+            sort_keys=True,
+        ).encode()
+    ).hexdigest()
+
+
+async def count_total(
+    info: Info,
+    query: FindMany,
+    pipe: list,
+    maintained: Optional[Tuple[Type[Document], str, str]] = None,
+    estimate: bool = False,
+) -> Tuple[int, bool]:
+    """
+    Returns `(total, estimated)` for the documents matched by `query` and `pipe`.
+
+    In order of preference the total comes from a counter maintained on another
+    document (`maintained` is `(model, id, field)`), from collection metadata
+    when nothing is filtered, from the count cache when the client accepts an
+    estimate, and only then from a `$count` aggregation.
+    """
+    if maintained:
+        total = await counter(*maintained)
+        if total is not None:
+            return total, False
+    elif not pipe and not query.get_filter_query():
+        collection = query.document_model.get_motor_collection()
+        return await collection.estimated_document_count(), True
+
+    key = count_key(query, pipe)
+    if estimate:
+        total = await info.context.counts.get(key)
+        if total is not None:
+            return total, True
+    try:
+        total = (
+            await query.aggregate(
+                aggregation_pipeline=[*pipe, {"$count": "total"}]
+            ).to_list()
+        )[0]["total"]
+    except IndexError:
+        total = 0
+    if maintained:
+        await backfill(*maintained, total)
+    await info.context.counts.set(key, total)
+    return total, False
@@ -1,26 +1,72 @@
-from typing import List
+import asyncio
+import hashlib
+import os
+import re
+from typing import List, Tuple
 
 from beanie.odm.fields import PydanticObjectId
+from opendal import AsyncOperator
 from strawberry.file_uploads import Upload
 from strawberry.types import Info
 
 from auth import authenticated
-from consts import MAX_FILE_SIZE
+from consts import MAX_FILE_SIZE, UPLOAD_CHUNK_SIZE, UPLOAD_CONCURRENCY
 from error import FileUploadError, FileUploadErrorType
-from models.file import File
+from images import enqueue
+from models.file import Blob, File
+
+
+def too_big() -> Exception:
+    return FileUploadError(
+        "Maximum file size is 32mb", tp=FileUploadErrorType.FILE_TOO_BIG
+    ).into()
+
+
+def extension(filename: str) -> str:
+    ext = os.path.splitext(filename or "")[1].lower()
+    return ext if re.fullmatch(r"\.[a-z0-9]{1,10}", ext) else ""
+
+
+async def store(operator: AsyncOperator, file: Upload, loc: str) -> Tuple[str, int]:
+    """
+    Streams the upload into storage one chunk at a time, enforcing the size
+    limit on the bytes actually received. Returns the sha256 digest and size.
+    """
+    writer = await operator.open(loc, "wb")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > MAX_FILE_SIZE:
+                raise too_big()
+            digest.update(chunk)
+            await writer.write(chunk)
+    except BaseException:
+        await writer.close()
+        await operator.delete(loc)
+        raise
+    await writer.close()
+    return digest.hexdigest(), size
 
 
 @authenticated()
 async def upload_files(files: List[Upload], info: Info) -> List[File]:
     user = await info.context.user()
-    res = []
     for file in files:
-        if file.size > MAX_FILE_SIZE:
-            raise FileUploadError(
-                "Maximum file size is 32mb", tp=FileUploadErrorType.FILE_TOO_BIG
+        if file.size and file.size > MAX_FILE_SIZE:
+            raise too_big()
+    limit = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+    async def upload(file: Upload) -> File:
+        async with limit:
+            tmp = f"tmp/{user.username}-{PydanticObjectId()}"
+            digest, size = await store(info.context.op, file, tmp)
+            blob = await Blob.put(
+                info.context.op, tmp, digest, size, extension(file.filename)
             )
-        content = await file.read()
-        f = File(loc=f"{user.username}/{PydanticObjectId()}-{file.filename}")
-        await f.save(info.context.op, content)
-        res.append(f)
-    return res
+            await enqueue(info.context.jobs, blob)
+            return blob.file(file.filename)
+
+    # Blobs stored before a failure are unreferenced and left to the collector
+    return await asyncio.gather(*map(upload, files))
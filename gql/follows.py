@@ -0,0 +1,138 @@
+import asyncio
+from time import time
+from typing import List, Optional
+
+from beanie.odm.fields import PydanticObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from strawberry.types import Info
+
+from auth import authenticated
+from consts import FEED_SIZE
+from error import FollowError, FollowErrorType
+from feed import page
+from gql import Page
+from gql.pagination import decode_cursor, encode_cursor
+from gql.selection import POST_FIELDS, projection
+from models.follow import DBFollow
+from models.forum import DBForum, Forum
+from models.post import DBPost, Post
+from search import ranked
+
+CURSOR_KEYS = [("_id", -1)]
+
+
+async def follow(info: Info, id: str, following: bool) -> DBForum:
+    """Follows or unfollows a forum as the current user."""
+    user = await info.context.user()
+    key = {"user_id": PydanticObjectId(user.id), "forum_id": PydanticObjectId(id)}
+    forums = DBForum.get_motor_collection()
+    forum = await forums.find_one({"_id": key["forum_id"]})
+    if not forum:
+        raise FollowError(
+            "Forum does not exist", tp=FollowErrorType.FORUM_NOT_FOUND
+        ).into()
+    follows = DBFollow.get_motor_collection()
+    if following:
+        try:
+            changed = (
+                await follows.update_one(
+                    key, {"$setOnInsert": {"created_at": int(time())}}, upsert=True
+                )
+            ).upserted_id is not None
+        except DuplicateKeyError:
+            # A concurrent request of the same user followed it first
+            changed = False
+    else:
+        changed = (await follows.delete_one(key)).deleted_count > 0
+    if not changed:
+        return DBForum.model_validate(forum)
+    forum = await forums.find_one_and_update(
+        {"_id": key["forum_id"]},
+        {"$inc": {"follower_count": 1 if following else -1}},
+        return_document=ReturnDocument.AFTER,
+    )
+    await asyncio.gather(
+        info.context.entities.invalidate("forum", id=id, name=forum["name"]),
+        info.context.feeds.drop(user.id),
+        resize(info, key["forum_id"], forum["follower_count"]),
+    )
+    return DBForum.model_validate(forum)
+
+
+@authenticated()
+async def follow_forum(info: Info, id: str) -> Forum:
+    """Adds a forum's posts to the current user's feed."""
+    return (await follow(info, id, True)).gql()
+
+
+@authenticated()
+async def unfollow_forum(info: Info, id: str) -> Forum:
+    return (await follow(info, id, False)).gql()
+
+
+async def followers(forum_id: PydanticObjectId) -> List[str]:
+    cursor = DBFollow.get_motor_collection().find(
+        {"forum_id": forum_id}, {"user_id": 1, "_id": 0}
+    )
+    return [str(follow["user_id"]) async for follow in cursor]
+
+
+async def resize(info: Info, forum_id: PydanticObjectId, follower_count: int):
+    if await info.context.feeds.resize(str(forum_id), follower_count):
+        # Their timelines were built without the forum, which was merged on read
+        await info.context.feeds.drop(*await followers(forum_id))
+
+
+async def fan_out(info: Info, post: DBPost, follower_count: int):
+    """Pushes a new post to the feeds of its forum's followers."""
+    feeds = info.context.feeds
+    users = []
+    if not feeds.large(follower_count):
+        users = await followers(post.forum_id)
+    await asyncio.gather(
+        feeds.push(str(post.id), str(post.forum_id), users),
+        # Keeps the large forums right should Redis have lost them
+        resize(info, post.forum_id, follower_count),
+    )
+
+
+async def latest_posts(forums: List[str]) -> List[str]:
+    if not forums:
+        return []
+    cursor = (
+        DBPost.get_motor_collection()
+        .find({"forum_id": {"$in": [*map(PydanticObjectId, forums)]}}, {"_id": 1})
+        .sort("_id", -1)
+        .limit(FEED_SIZE)
+    )
+    return [str(post["_id"]) async for post in cursor]
+
+
+@authenticated()
+async def get_feed(
+    info: Info, limit: int = 10, cursor: Optional[str] = None
+) -> Page[Post]:
+    """Latest posts of the forums the current user follows, newest first."""
+    user = await info.context.user()
+    follows = DBFollow.get_motor_collection().find(
+        {"user_id": PydanticObjectId(user.id)}, {"forum_id": 1, "_id": 0}
+    )
+    forums = [str(follow["forum_id"]) async for follow in follows]
+    ids = await info.context.feeds.read(user.id, forums, latest_posts)
+    before = str(decode_cursor(CURSOR_KEYS, cursor)[-1]) if cursor else None
+    limit = max(min(20, limit), 1)
+    items, more = page(ids, before, limit)
+    posts = []
+    if items:
+        pipe = ranked(items) + projection(info, POST_FIELDS, "items")
+        posts = await DBPost.aggregate(pipe, projection_model=DBPost).to_list()
+
+    return Page(
+        # Only the latest posts of each forum are kept in feeds
+        total=len(ids),
+        estimated=True,
+        next_page=None,
+        next_cursor=encode_cursor(CURSOR_KEYS, posts[-1]) if more and posts else None,
+        items=[*map(DBPost.gql, posts)],
+    )
@@ -1,5 +1,7 @@
-from typing import List, Optional
+import asyncio
+from typing import List, Optional, Type
 
+from beanie import Document
 from beanie.odm.fields import PydanticObjectId
 from beanie.operators import In
 from slugify import slugify
@@ -8,8 +10,57 @@ from strawberry.types import Info
 from auth import authenticated
 from error import ForumCreationError, ForumCreationErrorType
 from gql import ForumSort, Page
+from gql.counts import count_total
+from gql.pagination import next_cursor, paginate, sort_keys
+from gql.selection import FORUM_FIELDS, projection, selected
 from models.forum import DBForum, Forum
 
+SORT_KEYS = {
+    ForumSort.CREATED_AT_ASC: [("created_at", 1)],
+    ForumSort.CREATED_AT_DESC: [("created_at", -1)],
+}
+
+
+def banned(user_id: PydanticObjectId) -> dict:
+    """Expression telling whether the user is banned, so the ban list stays in the db."""
+    return {"$in": [user_id, "$banned_members"]}
+
+
+async def ban_lookup(
+    model: Type[Document], id: str, user_id: PydanticObjectId
+) -> Optional[dict]:
+    """
+    Fetches `_id` and `forum_id` of a post or comment together with whether the
+    user is `banned` in its forum, in a single round trip.
+    """
+    docs = (
+        await model.get_motor_collection()
+        .aggregate(
+            [
+                {"$match": {"_id": PydanticObjectId(id)}},
+                {
+                    "$lookup": {
+                        "from": DBForum.get_motor_collection().name,
+                        "let": {"forum_id": "$forum_id"},
+                        "pipeline": [
+                            {"$match": {"$expr": {"$eq": ["$_id", "$$forum_id"]}}},
+                            {"$project": {"banned": banned(user_id)}},
+                        ],
+                        "as": "forum",
+                    }
+                },
+                {
+                    "$project": {
+                        "forum_id": 1,
+                        "banned": {"$arrayElemAt": ["$forum.banned", 0]},
+                    }
+                },
+            ]
+        )
+        .to_list(1)
+    )
+    return docs[0] if docs else None
+
 
 @authenticated(bot=False)
 async def create_forum(info: Info, name: str) -> Forum:
@@ -26,24 +77,31 @@ async def create_forum(info: Info, name: str) -> Forum:
             "Forum already exists",
             tp=ForumCreationErrorType.FORUM_ALREADY_EXISTS,
         )
-    return (
-        await DBForum(
-            name=name,
-            display_name=name,
-            owner_id=user.id,
-        ).insert()
-    ).gql()
+    forum = await DBForum(
+        name=name,
+        display_name=name,
+        owner_id=user.id,
+    ).insert()
+    await asyncio.gather(
+        info.context.search.add("forums", forum), info.context.responses.purge()
+    )
+    return forum.gql()
 
 
 async def get_forum(
-    id: Optional[str] = None, name: Optional[str] = None
+    info: Info, id: Optional[str] = None, name: Optional[str] = None
 ) -> Optional[Forum]:
     if id:
-        forum = await DBForum.find_one(DBForum.id == PydanticObjectId(id))
-        return forum.gql() if forum else None
+        return await info.context.entities.get(
+            "forum",
+            "id",
+            id,
+            lambda: DBForum.find_one(DBForum.id == PydanticObjectId(id)),
+        )
     if name:
-        forum = await DBForum.find_one(DBForum.name == name)
-        return forum.gql() if forum else None
+        return await info.context.entities.get(
+            "forum", "name", name, lambda: DBForum.find_one(DBForum.name == name)
+        )
 
 
 async def get_forums(
@@ -58,6 +116,8 @@ async def get_forums(
     sort: Optional[ForumSort] = None,
     page: int = 1,
     limit: int = 10,
+    cursor: Optional[str] = None,
+    estimate_total: bool = False,
 ) -> Page[Forum]:
     aggregation_pipe = []
     if ids:
@@ -69,54 +129,35 @@ async def get_forums(
         forums = DBForum.find(DBForum.owner_id == PydanticObjectId(owner_id))
     else:
         forums = DBForum.find_all()
-    if search:
-        aggregation_pipe.append(
-            {
-                "$search": {
-                    "index": "forums",
-                    "text": {
-                        "query": search,
-                        "path": ["name", "display_name", "description"],
-                        "fuzzy": {},
-                    },
-                }
-            }
-        )
     if isinstance(locked, bool):
         aggregation_pipe.append({"$match": {"locked": locked}})
     if created_after:
         aggregation_pipe.append({"$match": {"created_at": {"$gt": created_after}}})
     if created_before:
         aggregation_pipe.append({"$match": {"created_at": {"$lt": created_before}}})
-    if sort:
-        if sort == ForumSort.CREATED_AT_ASC:
-            aggregation_pipe.append({"$sort": {"created_at": 1}})
-        elif sort == ForumSort.CREATED_AT_DESC:
-            aggregation_pipe.append({"$sort": {"created_at": -1}})
-    total = 0
-    for selection in info.selected_fields:
-        if selection.name == "getForums":
-            for field in selection.selections:
-                if field.name == "total":
-                    p = aggregation_pipe.copy()
-                    p.append({"$count": "total"})
-                    try:
-                        total = (
-                            await forums.aggregate(aggregation_pipeline=p).to_list()
-                        )[0]["total"]
-                    except:
-                        pass
-                    break
-
     page = max(1, page)
     limit = max(min(20, limit), 1)
-    aggregation_pipe.append({"$skip": limit * (page - 1)})
-    aggregation_pipe.append({"$limit": limit})
+    searched = None
+    if search:
+        aggregation_pipe, searched = await info.context.search.stages(
+            "forums", search, forums, aggregation_pipe, 0 if sort else page * limit
+        )
+    keys = None if search and not sort else sort_keys(SORT_KEYS.get(sort, []))
+    total, estimated = searched or 0, False
+    if "total" in selected(info) and searched is None:
+        total, estimated = await count_total(
+            info, forums, aggregation_pipe, estimate=estimate_total
+        )
+
+    paginate(aggregation_pipe, keys, cursor, page, limit)
+    aggregation_pipe += projection(info, FORUM_FIELDS, "items")
     forums = forums.aggregate(aggregation_pipe, projection_model=DBForum)
     forums = await forums.to_list()
 
     return Page(
         total=total,
-        next_page=page + 1 if len(forums) == limit else None,
+        estimated=estimated,
+        next_page=page + 1 if len(forums) == limit and not cursor else None,
+        next_cursor=next_cursor(keys, forums, limit),
         items=[*map(DBForum.gql, forums)],
     )
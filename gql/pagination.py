@@ -0,0 +1,84 @@
+import base64
+import json
+from typing import Any, List, Optional, Sequence, Tuple
+
+from beanie.odm.fields import PydanticObjectId
+
+from error import InvalidGetQuery
+
+SortKeys = List[Tuple[str, int]]
+
+
+def sort_keys(keys: SortKeys) -> SortKeys:
+    """
+    Makes a sort order total by appending `_id` as the final tie breaker, so a
+    cursor always points at exactly one position.
+    """
+    return [*keys, ("_id", keys[-1][1] if keys else 1)]
+
+
+def encode_cursor(keys: SortKeys, item: Any) -> str:
+    values = [
+        str(item.id) if field == "_id" else getattr(item, field) for field, _ in keys
+    ]
+    return base64.urlsafe_b64encode(
+        json.dumps(values, separators=(",", ":")).encode()
+    ).decode()
+
+
+def decode_cursor(keys: SortKeys, cursor: str) -> List[Any]:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != len(keys):
+            raise ValueError
+        values[-1] = PydanticObjectId(values[-1])
+    except Exception:
+        raise InvalidGetQuery().gql()
+    return values
+
+
+def seek(keys: SortKeys, values: List[Any]) -> dict:
+    """
+    Range match selecting everything strictly after `values` in `keys` order.
+    The leading bound lets the planner turn it into index bounds.
+    """
+    clauses = []
+    for i, (field, direction) in enumerate(keys):
+        clause = {f: v for (f, _), v in zip(keys[:i], values[:i])}
+        clause[field] = {"$gt" if direction == 1 else "$lt": values[i]}
+        clauses.append(clause)
+    field, direction = keys[0]
+    return {field: {"$gte" if direction == 1 else "$lte": values[0]}, "$or": clauses}
+
+
+def paginate(
+    pipe: list,
+    keys: Optional[SortKeys],
+    cursor: Optional[str],
+    page: int,
+    limit: int,
+):
+    """
+    Appends sort and paging stages to `pipe`. With a cursor the page is found by
+    seeking on the sort keys, otherwise by skipping. `keys` is None when results
+    keep their search relevance order, which can only be paged by skipping.
+    """
+    if keys is None:
+        if cursor:
+            raise InvalidGetQuery().gql()
+        pipe.append({"$skip": limit * (page - 1)})
+    elif cursor:
+        pipe.append({"$match": seek(keys, decode_cursor(keys, cursor))})
+        pipe.append({"$sort": dict(keys)})
+    else:
+        pipe.append({"$sort": dict(keys)})
+        pipe.append({"$skip": limit * (page - 1)})
+    pipe.append({"$limit": limit})
+
+
+def next_cursor(
+    keys: Optional[SortKeys], items: Sequence[Any], limit: int
+) -> Optional[str]:
+    if keys is None or len(items) < limit:
+        return None
+    return encode_cursor(keys, items[-1])
@@ -1,3 +1,4 @@
+import asyncio
 from typing import List, Optional
 
 from beanie.odm.fields import PydanticObjectId
@@ -5,10 +6,46 @@ from beanie.operators import In
 from strawberry.types import Info
 
 from auth import authenticated
-from error import PostCreationError, PostCreationErrorType
+from error import InvalidGetQuery, PostCreationError, PostCreationErrorType
 from gql import Page, PostSort
+from gql.counts import count_total
+from gql.follows import fan_out
+from gql.forums import banned
+from gql.pagination import next_cursor, paginate, sort_keys
+from gql.selection import POST_FIELDS, projection, selected
+from gql.subscriptions import publish
+from models.file import Blob, File
 from models.forum import DBForum
 from models.post import DBPoll, DBPost, Post
+from models.user import DBUser
+from ranking import Rankings
+from search import ranked
+
+# Pinned posts always lead, the requested order applies within each group
+SORT_KEYS = {
+    PostSort.CREATED_AT_ASC: [("pinned", -1), ("created_at", 1)],
+    PostSort.CREATED_AT_DESC: [("pinned", -1), ("created_at", -1)],
+    PostSort.PINNED: [("pinned", -1)],
+    PostSort.UPVOTES: [("pinned", -1), ("upvotes", -1)],
+    PostSort.DOWNVOTES: [("pinned", -1), ("downvotes", -1)],
+    PostSort.MODIFIED_AT_ASC: [("pinned", -1), ("modified_at", 1)],
+    PostSort.MODIFIED_AT_DESC: [("pinned", -1), ("modified_at", -1)],
+}
+# Orders read from the rankings, of a forum or of every post
+RANKINGS = {PostSort.HOT: "hot", PostSort.TOP: "top"}
+
+
+async def attachment_files(attachments: Optional[List[str]]) -> Optional[List[File]]:
+    if not attachments:
+        return None
+    blobs = {
+        blob.loc: blob for blob in await Blob.find(In(Blob.loc, attachments)).to_list()
+    }
+    if len(blobs) != len(set(attachments)):
+        raise PostCreationError(
+            "Attachment not found", tp=PostCreationErrorType.INVALID_ATTACHMENT
+        ).into()
+    return [blobs[loc].file() for loc in attachments]
 
 
 @authenticated()
@@ -23,50 +60,79 @@ async def create_post(
     rolling: bool = False,
 ) -> Post:
     user = await info.context.user()
-    forum: DBForum = await DBForum.find_one(DBForum.id == PydanticObjectId(forum_id))
+    if poll and len(poll) < 2:
+        raise PostCreationError(
+            "Poll should atlest have 2 options", tp=PostCreationErrorType.INVALID_POLL
+        ).into()
+    user_id = PydanticObjectId(user.id)
+    forum, files = await asyncio.gather(
+        DBForum.get_motor_collection().find_one(
+            {"_id": PydanticObjectId(forum_id)},
+            {
+                "name": 1,
+                "locked": 1,
+                "follower_count": 1,
+                "banned": banned(user_id),
+            },
+        ),
+        attachment_files(attachments),
+    )
     if not forum:
         raise PostCreationError(
             "Forum not found", tp=PostCreationErrorType.FORUM_NOT_FOUND
         ).into()
-    if forum.locked and not user.admin:
+    if forum["locked"] and not user.admin:
         raise PostCreationError(
             "Forum is locked", tp=PostCreationErrorType.LOCKED_FORUM
         ).into()
-    if user.id in forum.banned_members:
+    if forum["banned"]:
         raise PostCreationError(
             "You are banned in this forum", tp=PostCreationErrorType.BANNED_MEMBER
         ).into()
-    if poll and len(poll) < 2:
-        raise PostCreationError(
-            "Poll should atlest have 2 options", tp=PostCreationErrorType.INVALID_POLL
-        ).into()
-    forum.post_count += 1
-    await forum.save()
-    return (
-        await DBPost(
-            title=title,
-            tags=tags,
-            content=content,
-            attachments=(
-                [*map(lambda a: File(loc=a), attachments)] if attachments else None
-            ),
-            poll=(
-                DBPoll(
-                    options=poll, results=[0] * len(poll), participants=[[]] * len(poll)
-                )
-                if poll
-                else None
-            ),
-            poster_id=user.id,
-            forum_id=forum.id,
-            rolling=rolling,
-        ).insert()
-    ).gql()
+    post = await DBPost(
+        title=title,
+        tags=tags,
+        content=content,
+        attachments=files,
+        poll=(
+            DBPoll(options=poll, results=[0] * len(poll), participants=[[]] * len(poll))
+            if poll
+            else None
+        ),
+        poster_id=user_id,
+        forum_id=forum["_id"],
+        rolling=rolling,
+    ).insert()
+    # Counters only move once the post exists, each with a single $inc
+    counters = [
+        DBForum.find_one(DBForum.id == forum["_id"]).inc({DBForum.post_count: 1}),
+        # Users created before post_count existed are backfilled by get_posts
+        DBUser.find_one(DBUser.id == user_id, {"post_count": {"$exists": True}}).inc(
+            {DBUser.post_count: 1}
+        ),
+    ]
+    if attachments:
+        counters.append(Blob.find(In(Blob.loc, attachments)).inc({Blob.refs: 1}))
+    await asyncio.gather(*counters)
+    # Invalidated once the counters moved, or a concurrent read caches them stale
+    await asyncio.gather(
+        info.context.responses.purge(f"forum:{forum['_id']}"),
+        info.context.entities.invalidate(
+            "forum", id=str(forum["_id"]), name=forum["name"]
+        ),
+        info.context.entities.invalidate("user", id=user.id, username=user.username),
+        publish(info.context.broadcast, "POST_NEW", forum["_id"], post.id, post),
+        info.context.search.add("posts", post),
+        info.context.rankings.update(post),
+        fan_out(info, post, forum.get("follower_count", 0)),
+    )
+    return post.gql()
 
 
-async def get_post(id: str) -> Optional[Post]:
-    post = await DBPost.find_one(DBPost.id == PydanticObjectId(id))
-    return post.gql() if post else None
+async def get_post(info: Info, id: str) -> Optional[Post]:
+    return await info.context.entities.get(
+        "post", "id", id, lambda: DBPost.find_one(DBPost.id == PydanticObjectId(id))
+    )
 
 
 async def get_posts(
@@ -81,7 +147,14 @@ async def get_posts(
     sort: Optional[PostSort] = None,
     page: int = 1,
     limit: int = 10,
+    cursor: Optional[str] = None,
+    estimate_total: bool = False,
 ) -> Page[Post]:
+    ranking = RANKINGS.get(sort)
+    if ranking and (
+        ids or poster_id or tags or search or created_after or created_before
+    ):
+        raise InvalidGetQuery().gql()
     aggregation_pipe = []
     if ids:
         ids = [*map(PydanticObjectId, ids)]
@@ -94,61 +167,64 @@ async def get_posts(
         posts = DBPost.find(All(DBPost.tags, tags))
     else:
         posts = DBPost.find_all()
-    if search:
-        aggregation_pipe.append(
-            {
-                "$search": {
-                    "index": "posts",
-                    "text": {
-                        "query": search,
-                        "path": ["title", "tags", "content", "poll.options"],
-                        "fuzzy": {},
-                    },
-                }
-            }
-        )
     if created_after:
         aggregation_pipe.append({"$match": {"created_at": {"$gt": created_after}}})
     if created_before:
         aggregation_pipe.append({"$match": {"created_at": {"$lt": created_before}}})
-    if sort:
-        if sort == PostSort.CREATED_AT_ASC:
-            aggregation_pipe.append({"$sort": {"created_at": 1}})
-        elif sort == PostSort.CREATED_AT_DESC:
-            aggregation_pipe.append({"$sort": {"created_at": -1}})
-        elif sort == PostSort.MODIFIED_AT_ASC:
-            aggregation_pipe.append({"$sort": {"modified_at": 1}})
-        elif sort == PostSort.MODIFIED_AT_DESC:
-            aggregation_pipe.append({"$sort": {"modified_at": -1}})
-        elif sort == PostSort.UPVOTES:
-            aggregation_pipe.append({"$sort": {"upvotes": 1}})
-        elif sort == PostSort.DOWNVOTES:
-            aggregation_pipe.append({"$sort": {"downvotes": 1}})
-    aggregation_pipe.append({"$sort": {"pinned": 1}})
-    total = 0
-    for selection in info.selected_fields:
-        if selection.name == "getPosts":
-            for field in selection.selections:
-                if field.name == "total":
-                    p = aggregation_pipe.copy()
-                    p.append({"$count": "total"})
-                    try:
-                        total = (
-                            await posts.aggregate(aggregation_pipeline=p).to_list()
-                        )[0]["total"]
-                    except:
-                        pass
-                    break
-
     page = max(1, page)
     limit = max(min(20, limit), 1)
-    aggregation_pipe.append({"$skip": limit * (page - 1)})
-    aggregation_pipe.append({"$limit": limit})
+    searched = None
+    if search:
+        aggregation_pipe, searched = await info.context.search.stages(
+            "posts", search, posts, aggregation_pipe, 0 if sort else page * limit
+        )
+    keys = (
+        None
+        if search and not sort
+        else sort_keys(SORT_KEYS.get(sort, SORT_KEYS[PostSort.PINNED]))
+    )
+    maintained = None
+    if not aggregation_pipe and not ids:
+        if poster_id:
+            maintained = (DBUser, poster_id, "post_count")
+        elif forum_id:
+            maintained = (DBForum, forum_id, "post_count")
+    total, estimated = searched or 0, False
+    if "total" in selected(info) and searched is None:
+        total, estimated = await count_total(
+            info,
+            posts,
+            aggregation_pipe,
+            maintained,
+            estimate=estimate_total,
+        )
+
+    if ranking:
+        # Only the page is read from mongo, however large the forum
+        entries = await info.context.rankings.page(
+            ranking, forum_id, page, limit, cursor
+        )
+        posts = []
+        if entries:
+            pipe = ranked([entry.id for entry in entries])
+            pipe += projection(info, POST_FIELDS, "items")
+            posts = await DBPost.aggregate(pipe, projection_model=DBPost).to_list()
+        return Page(
+            total=total,
+            estimated=estimated,
+            next_page=page + 1 if len(entries) == limit and not cursor else None,
+            next_cursor=Rankings.next_cursor(entries, limit),
+            items=[*map(DBPost.gql, posts)],
+        )
+    paginate(aggregation_pipe, keys, cursor, page, limit)
+    aggregation_pipe += projection(info, POST_FIELDS, "items")
     posts = posts.aggregate(aggregation_pipe, projection_model=DBPost)
     posts = await posts.to_list()
 
     return Page(
         total=total,
-        next_page=page + 1 if len(posts) == limit else None,
+        estimated=estimated,
+        next_page=page + 1 if len(posts) == limit and not cursor else None,
+        next_cursor=next_cursor(keys, posts, limit),
         items=[*map(DBPost.gql, posts)],
     )
@@ -0,0 +1,53 @@
+from typing import Any, Dict, Iterable, List, Set
+
+from strawberry.types import Info
+from strawberry.types.nodes import SelectedField, Selection
+from strawberry.utils.str_converters import to_camel_case
+
+# Fields that can be large, with the placeholder sent when they aren't selected
+POST_FIELDS = {"content": None, "poll": None, "participants": [], "attachments": None}
+COMMENT_FIELDS = {"content": ""}
+FORUM_FIELDS = {"description": None, "moderators": [], "banned_members": []}
+USER_FIELDS = {"bio": None, "starred_by": []}
+
+
+def fields(selections: Iterable[Selection]) -> List[SelectedField]:
+    """Flattens fragments into the fields they select."""
+    out = []
+    for selection in selections:
+        if isinstance(selection, SelectedField):
+            out.append(selection)
+        else:
+            out += fields(selection.selections)
+    return out
+
+
+def selected(info: Info, *path: str) -> Set[str]:
+    """
+    Names of the fields selected on the resolved field, or on the field found
+    by following `path` from it, e.g. `selected(info, "items")` for a page.
+    """
+    selections = [child for field in info.selected_fields for child in field.selections]
+    for name in path:
+        selections = [
+            child
+            for field in fields(selections)
+            if field.name == name
+            for child in field.selections
+        ]
+    return {field.name for field in fields(selections)}
+
+
+def projection(info: Info, heavy: Dict[str, Any], *path: str) -> List[dict]:
+    """
+    Pipeline stages replacing the `heavy` fields the client didn't select under
+    `path` by their placeholder, so they are never sent by the database.
+    Placeholders keep the documents valid for their model.
+    """
+    chosen = selected(info, *path)
+    unselected = {
+        field: {"$literal": placeholder}
+        for field, placeholder in heavy.items()
+        if to_camel_case(field) not in chosen
+    }
+    return [{"$set": unselected}] if unselected else []
@@ -1,10 +1,195 @@
-import ast
+import asyncio
+import json
+from collections import OrderedDict
+from enum import Enum
+from itertools import count
+from typing import Any, Dict, Iterable, List, Optional, Set
 
+from beanie import Document
+from beanie.odm.fields import PydanticObjectId
 from broadcaster import Broadcast
-from fastapi import APIRouter, WebSocket
+from bson import ObjectId
+from fastapi import APIRouter, Query, WebSocket
+
+import events
+import metrics
+from consts import RTE_MAX_TOPICS, RTE_QUEUE_POLICY, RTE_QUEUE_SIZE
+from hub import Hub, forum_channel
+from models.forum import DBForum
+from models.post import DBPost
 
 router = APIRouter()
 
+EVENTS = ("COMMENT_NEW", "COMMENT_EDIT", "POST_NEW", "POST_EDIT")
+
+
+async def publish(broadcast: Broadcast, event: str, forum_id, post_id, item: Document):
+    """Publishes `event` to every realtime client following the forum or post."""
+    await broadcast.publish(
+        channel=forum_channel(forum_id),
+        message=events.encode(event, forum_id, post_id, item),
+    )
+
+
+def object_ids(values: Any) -> List[str]:
+    """Ids sent by a client, raises ValueError unless they are a list of ObjectIds."""
+    if not isinstance(values, list) or not all(
+        isinstance(value, str) and ObjectId.is_valid(value) for value in values
+    ):
+        raise ValueError
+    return [*dict.fromkeys(str(ObjectId(value)) for value in values)]
+
+
+async def existing_forums(ids: List[str]) -> List[str]:
+    if not ids:
+        return []
+    cursor = DBForum.get_motor_collection().find(
+        {"_id": {"$in": [*map(PydanticObjectId, ids)]}}, {"_id": 1}
+    )
+    return [str(forum["_id"]) async for forum in cursor]
+
+
+async def post_forums(ids: List[str]) -> Dict[str, str]:
+    if not ids:
+        return {}
+    cursor = DBPost.get_motor_collection().find(
+        {"_id": {"$in": [*map(PydanticObjectId, ids)]}}, {"forum_id": 1}
+    )
+    return {str(post["_id"]): str(post["forum_id"]) async for post in cursor}
+
+
+class Topics:
+    """
+    What a realtime client follows: whole forums, single posts and the kinds of
+    events it wants. Events are published per forum, so following a post
+    listens on its forum's channel.
+    """
+
+    def __init__(self, events: Iterable[str]):
+        self.forums: Set[str] = set()
+        self.posts: Dict[str, str] = {}
+        self.events: Set[str] = set(events)
+
+    async def subscribe(self, forums: Any, posts: Any, events: Any):
+        """
+        Follows the forums and posts that exist, raises ValueError for malformed
+        topics or when more than RTE_MAX_TOPICS would be followed. Every forum
+        followed is a broadcast subscription of the worker.
+        """
+        forums = [id for id in object_ids(forums) if id not in self.forums]
+        posts = [id for id in object_ids(posts) if id not in self.posts]
+        if not isinstance(events, list):
+            raise ValueError
+        following = len(self.forums) + len(self.posts)
+        if following + len(forums) + len(posts) > RTE_MAX_TOPICS:
+            raise ValueError
+        self.forums.update(await existing_forums(forums))
+        self.posts.update(await post_forums(posts))
+        self.events.update(e for e in events if e in EVENTS)
+
+    async def unsubscribe(self, forums: Any, posts: Any, events: Any):
+        if not isinstance(events, list):
+            raise ValueError
+        self.forums.difference_update(object_ids(forums))
+        for post in object_ids(posts):
+            self.posts.pop(post, None)
+        self.events.difference_update(e for e in events if e in EVENTS)
+
+
+class OverflowPolicy(Enum):
+    DROP_OLDEST = "drop_oldest"
+    # Like DROP_OLDEST, but a queued edit is replaced by a newer edit of the same item
+    COALESCE = "coalesce"
+    DISCONNECT = "disconnect"
+
+
+class Outbox:
+    """
+    Bounded queue of events waiting to be written to a websocket, so a slow
+    client can't make the worker buffer events without limit.
+    """
+
+    def __init__(self, maxsize: int, policy: OverflowPolicy):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items: OrderedDict = OrderedDict()
+        self.seq = count()
+        self.ready = asyncio.Event()
+        self.overflowed = False
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def put(self, event: events.Event):
+        if self.policy == OverflowPolicy.COALESCE and event.event.endswith("_EDIT"):
+            key = (event.event, event.item_id)
+            if key in self.items:
+                self.items[key] = event
+                metrics.inc("rte.coalesced")
+                return
+        else:
+            key = next(self.seq)
+        if len(self.items) >= self.maxsize:
+            metrics.inc("rte.dropped")
+            if self.policy == OverflowPolicy.DISCONNECT:
+                self.overflowed = True
+                self.ready.set()
+                return
+            self.items.popitem(last=False)
+        self.items[key] = event
+        self.ready.set()
+
+    async def get(self) -> Optional[events.Event]:
+        """Returns the oldest event, or None once the outbox overflowed."""
+        while not self.items and not self.overflowed:
+            self.ready.clear()
+            await self.ready.wait()
+        if self.overflowed:
+            return None
+        return self.items.popitem(last=False)[1]
+
+
+class Connection:
+    open: Set["Connection"] = set()
+
+    def __init__(self, ws: WebSocket, topics: Topics):
+        self.ws = ws
+        self.topics = topics
+        self.outbox = Outbox(RTE_QUEUE_SIZE, OverflowPolicy(RTE_QUEUE_POLICY))
+
+    def send(self, event: events.Event):
+        self.outbox.put(event)
+
+    async def run(self):
+        """Writes queued events until the outbox overflows."""
+        while event := await self.outbox.get():
+            await self.ws.send_text(event.payload)
+
+
+metrics.gauge("rte.queued", lambda: sum(map(len, Connection.open)))
+metrics.gauge("rte.max_queue_depth", lambda: max(map(len, Connection.open), default=0))
+
+
+async def control(ws: WebSocket, conn: Connection, hub: Hub):
+    async for text in ws.iter_text():
+        try:
+            msg = json.loads(text)
+            args = (
+                msg.get("forums", []),
+                msg.get("posts", []),
+                msg.get("events", []),
+            )
+            if msg["op"] == "subscribe":
+                await conn.topics.subscribe(*args)
+            elif msg["op"] == "unsubscribe":
+                await conn.topics.unsubscribe(*args)
+            else:
+                raise ValueError
+        except Exception:
+            await ws.send_json({"error": "INVALID_SUBSCRIPTION"})
+            continue
+        hub.sync(conn)
+
 
 @router.websocket("/")
 async def rte_websocket(
@@ -13,17 +198,34 @@ async def rte_websocket(
     comment_edit: bool = False,
     post_new: bool = False,
     post_edit: bool = False,
+    forums: List[str] = Query([]),
+    posts: List[str] = Query([]),
 ):
-    broadcast: Broadcast = ws.state.broadcast
+    """
+    Subscriptions can be changed on the open socket by sending
+    `{"op": "subscribe" | "unsubscribe", "forums": [...], "posts": [...], "events": [...]}`,
+    up to RTE_MAX_TOPICS forums and posts in all.
+    Clients that fall RTE_QUEUE_SIZE events behind lose events or, with the
+    disconnect policy, get closed with code 1013 and should reconnect.
+    """
+    hub: Hub = ws.state.hub
     await ws.accept()
-    async with broadcast.subscribe(channel="f") as subscriber:
-        async for event in subscriber:
-            msg = ast.literal_eval(event.message)
-            if msg["event"] == "COMMENT_NEW" and comment_new:
-                await ws.send_json(msg)
-            elif msg["event"] == "COMMENT_EDIT" and not comment_edit:
-                continue
-            elif msg["event"] == "POST_NEW" and not post_new:
-                continue
-            elif msg["event"] == "POST_EDIT" and not post_edit:
-                continue
+    flags = (comment_new, comment_edit, post_new, post_edit)
+    conn = Connection(ws, Topics(event for event, flag in zip(EVENTS, flags) if flag))
+    try:
+        await conn.topics.subscribe(forums, posts, [])
+    except Exception:
+        await ws.send_json({"error": "INVALID_SUBSCRIPTION"})
+    hub.sync(conn)
+    Connection.open.add(conn)
+    sender = asyncio.create_task(conn.run())
+    receiver = asyncio.create_task(control(ws, conn, hub))
+    try:
+        await asyncio.wait((sender, receiver), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        sender.cancel()
+        receiver.cancel()
+        hub.remove(conn)
+        Connection.open.discard(conn)
+    if conn.outbox.overflowed:
+        await ws.close(code=1013)
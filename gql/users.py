@@ -18,6 +18,9 @@ from auth import authenticated
 from consts import MAX_SESSIONS
 from error import InvalidCredentials, UserCreationError, UserCreationErrorType
 from gql import BotCreds, Ok, Page, UserSort
+from gql.counts import count_total
+from gql.pagination import next_cursor, paginate, sort_keys
+from gql.selection import USER_FIELDS, projection, selected
 from models.user import DBUser, User, UserSecret
 
 DEV = os.getenv("DEV")
@@ -38,10 +41,28 @@ if not DEV:
         VALIDATE_CERTS=True,
     )
 
+SORT_KEYS = {
+    UserSort.CREATED_AT_ASC: [("created_at", 1)],
+    UserSort.CREATED_AT_DESC: [("created_at", -1)],
+}
+
 email_regex = r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,7}\b"
 username_regex = r"^(?=.*[a-z])[a-z0-9_]+$"
 
 
+# Run through info.context.crypto, they take tens of milliseconds each
+def encrypt_password(info: Info, password: str) -> bytes:
+    return info.context.email_cipher.encrypt(
+        info.context.argon2.hash(password).encode()
+    )
+
+
+def verify_password(info: Info, encrypted: bytes, password: str) -> bool:
+    return info.context.argon2.verify(
+        info.context.email_cipher.decrypt(encrypted), password
+    )
+
+
 async def create_user(username: str, email: str, password: str, info: Info) -> Ok:
     """
     Can fail: Check UserCreationErrorType for error types. Error extension is set as `tp`.
@@ -75,12 +96,16 @@ async def create_user(username: str, email: str, password: str, info: Info) -> O
         ).into()
 
     # hash email
-    email_hash = info.context.email_hasher.derive(email.encode())
+    email_hash = await info.context.crypto.run(
+        info.context.email_hasher.derive, email.encode()
+    )
     # Silently drop if email exists
     u = await UserSecret.find_one(UserSecret.email_hash == email_hash)
     if u:
         return Ok(msg="Check your email")
-    ect = info.context.email_cipher.encrypt(email.encode())
+    ect = await info.context.crypto.run(
+        info.context.email_cipher.encrypt, email.encode()
+    )
 
     code = random.randint(10000, 99999)
     user = DBUser(
@@ -90,9 +115,7 @@ async def create_user(username: str, email: str, password: str, info: Info) -> O
     user_secret = UserSecret(
         email=ect,
         email_hash=email_hash,
-        password=info.context.email_cipher.encrypt(
-            info.context.argon2.hash(password).encode()
-        ),
+        password=await info.context.crypto.run(encrypt_password, info, password),
     )
 
     await info.context.pending.set(username, [code, user, user_secret, 0])
@@ -141,20 +164,23 @@ async def create_bot(info: Info, username: str) -> BotCreds:
 
     email = str(PydanticObjectId())
     password = "".join(secrets.choice(alphabet) for i in range(20))
-    ect = info.context.email_cipher.encrypt(email.encode())
-    email_hash = info.context.email_hasher.derive(email.encode())
+    ect = await info.context.crypto.run(
+        info.context.email_cipher.encrypt, email.encode()
+    )
+    email_hash = await info.context.crypto.run(
+        info.context.email_hasher.derive, email.encode()
+    )
 
     bot = DBUser(username=username, display_name=username, bot=True, bot_owner=owner.id)
     await bot.insert()
     user_secret = UserSecret(
         email=ect,
         email_hash=email_hash,
-        password=info.context.email_cipher.encrypt(
-            info.context.argon2.hash(password).encode()
-        ),
+        password=await info.context.crypto.run(encrypt_password, info, password),
         user_id=bot.id,
     )
     await user_secret.insert()
+    await info.context.search.add("users", bot)
     return BotCreds(token=f"{email}@{password}")
 
 
@@ -184,6 +210,7 @@ async def verify_user(username: str, code: str, info: Info) -> User:
     await user.insert()
     user_secret.user_id = user.id
     await user_secret.insert()
+    await info.context.search.add("users", user)
     return user.gql()
 
 
@@ -191,16 +218,22 @@ async def login(email: str, password: str, info: Info) -> User:
     u = await info.context.user()
     if u:
         return u
-    email_hash = info.context.email_hasher.derive(email.encode())
+    email_hash = await info.context.crypto.run(
+        info.context.email_hasher.derive, email.encode()
+    )
     user_secret = await UserSecret.find_one(UserSecret.email_hash == email_hash)
     if not user_secret:
         raise InvalidCredentials().gql()
-    user_email = info.context.email_cipher.decrypt(user_secret.email).decode()
+    user_email = (
+        await info.context.crypto.run(
+            info.context.email_cipher.decrypt, user_secret.email
+        )
+    ).decode()
     if not compare_digest(user_email, email):
         raise InvalidCredentials().gql()
     try:
-        if info.context.argon2.verify(
-            info.context.email_cipher.decrypt(user_secret.password), password
+        if await info.context.crypto.run(
+            verify_password, info, user_secret.password, password
         ):
             user = await DBUser.find_one(DBUser.id == user_secret.user_id)
             uuid = uuid4()
@@ -236,19 +269,25 @@ async def me(info: Info) -> User:
     return await info.context.user()
 
 
-# @cache Maybe cache
 async def get_user(
-    id: Optional[str] = None, username: Optional[str] = None
+    info: Info, id: Optional[str] = None, username: Optional[str] = None
 ) -> Optional[User]:
     if id:
-        user = await DBUser.find_one(DBUser.id == PydanticObjectId(id))
-        return user.gql() if user else None
+        return await info.context.entities.get(
+            "user",
+            "id",
+            id,
+            lambda: DBUser.find_one(DBUser.id == PydanticObjectId(id)),
+        )
     if username:
-        user = await DBUser.find_one(DBUser.username == username)
-        return user.gql() if user else None
+        return await info.context.entities.get(
+            "user",
+            "username",
+            username,
+            lambda: DBUser.find_one(DBUser.username == username),
+        )
 
 
-# @cache Maybe cache
 async def get_users(
     info: Info,
     ids: Optional[List[str]] = None,
@@ -261,6 +300,8 @@ async def get_users(
     sort: Optional[UserSort] = None,
     page: int = 1,
     limit: int = 10,
+    cursor: Optional[str] = None,
+    estimate_total: bool = False,
 ) -> Page[User]:
     if ids:
         ids = [*map(PydanticObjectId, ids)]
@@ -270,19 +311,6 @@ async def get_users(
     else:
         users = DBUser.find_all()
     aggregation_pipe = []
-    if search:
-        aggregation_pipe.append(
-            {
-                "$search": {
-                    "index": "users",
-                    "text": {
-                        "query": search,
-                        "path": ["username", "display_name", "bio"],
-                        "fuzzy": {},
-                    },
-                }
-            }
-        )
     if isinstance(bot, bool):
         aggregation_pipe.append({"$match": {"bot": bot}})
     if isinstance(admin, bool):
@@ -291,35 +319,29 @@ async def get_users(
         aggregation_pipe.append({"$match": {"created_at": {"$gt": created_after}}})
     if created_before:
         aggregation_pipe.append({"$match": {"created_at": {"$lt": created_before}}})
-    if sort:
-        if sort == UserSort.CREATED_AT_ASC:
-            aggregation_pipe.append({"$sort": {"created_at": 1}})
-        elif seor == UserSort.CREATED_AT_DESC:
-            aggregation_pipe.append({"$sort": {"created_at": -1}})
-    total = 0
-    for selection in info.selected_fields:
-        if selection.name == "getUsers":
-            for field in selection.selections:
-                if field.name == "total":
-                    p = aggregation_pipe.copy()
-                    p.append({"$count": "total"})
-                    try:
-                        total = (
-                            await users.aggregate(aggregation_pipeline=p).to_list()
-                        )[0]["total"]
-                    except:
-                        pass
-                    break
-
     page = max(1, page)
     limit = max(min(20, limit), 1)
-    aggregation_pipe.append({"$skip": limit * (page - 1)})
-    aggregation_pipe.append({"$limit": limit})
+    searched = None
+    if search:
+        aggregation_pipe, searched = await info.context.search.stages(
+            "users", search, users, aggregation_pipe, 0 if sort else page * limit
+        )
+    keys = None if search and not sort else sort_keys(SORT_KEYS.get(sort, []))
+    total, estimated = searched or 0, False
+    if "total" in selected(info) and searched is None:
+        total, estimated = await count_total(
+            info, users, aggregation_pipe, estimate=estimate_total
+        )
+
+    paginate(aggregation_pipe, keys, cursor, page, limit)
+    aggregation_pipe += projection(info, USER_FIELDS, "items")
     users = users.aggregate(aggregation_pipe, projection_model=DBUser)
     users = await users.to_list()
 
     return Page(
         total=total,
-        next_page=page + 1 if len(users) == limit else None,
+        estimated=estimated,
+        next_page=page + 1 if len(users) == limit and not cursor else None,
+        next_cursor=next_cursor(keys, users, limit),
         items=[*map(DBUser.gql, users)],
     )
@@ -0,0 +1,122 @@
+import asyncio
+from time import time
+from typing import Optional, Type
+
+from beanie import Document
+from beanie.odm.fields import PydanticObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from strawberry.types import Info
+
+from auth import authenticated
+from error import VoteError, VoteErrorType
+from gql import Page
+from gql.counts import count_total
+from gql.forums import ban_lookup
+from gql.pagination import next_cursor, paginate, sort_keys
+from gql.selection import selected
+from models.comment import Comment, DBComment
+from models.post import DBPost, Post
+from models.user import User
+from models.vote import DBVote, Vote
+
+SORT_KEYS = sort_keys([("created_at", -1)])
+
+
+async def record(target_id: PydanticObjectId, user_id: PydanticObjectId, value: int):
+    """Stores the user's vote, 0 removes it. Returns the value it replaced."""
+    votes = DBVote.get_motor_collection()
+    key = {"target_id": target_id, "user_id": user_id}
+    if not value:
+        old = await votes.find_one_and_delete(key)
+    else:
+        update = {"$set": {"value": value}, "$setOnInsert": {"created_at": int(time())}}
+        try:
+            old = await votes.find_one_and_update(key, update, upsert=True)
+        except DuplicateKeyError:
+            # A concurrent first vote of the same user inserted it, update that one
+            old = await votes.find_one_and_update(key, update, upsert=True)
+    return old["value"] if old else 0
+
+
+async def cast(
+    info: Info, model: Type[Document], kind: str, id: str, vote: Optional[Vote]
+) -> Document:
+    user = await info.context.user()
+    user_id = PydanticObjectId(user.id)
+    target = await ban_lookup(model, id, user_id)
+    if not target:
+        raise VoteError(
+            "Vote target does not exist", tp=VoteErrorType.TARGET_NOT_FOUND
+        ).into()
+    if target["banned"]:
+        raise VoteError(
+            "You are banned in this forum", tp=VoteErrorType.BANNED_MEMBER
+        ).into()
+    value = vote.value if vote else 0
+    old = await record(target["_id"], user_id, value)
+    inc = {
+        field: (value == v) - (old == v)
+        for v, field in ((1, "upvotes"), (-1, "downvotes"))
+        if (value == v) != (old == v)
+    }
+    collection = model.get_motor_collection()
+    if not inc:
+        return model.model_validate(await collection.find_one({"_id": target["_id"]}))
+    doc = await collection.find_one_and_update(
+        {"_id": target["_id"]}, {"$inc": inc}, return_document=ReturnDocument.AFTER
+    )
+    updates = [info.context.entities.invalidate(kind, id=id)]
+    if model is DBPost:
+        updates.append(info.context.rankings.update(doc))
+    await asyncio.gather(*updates)
+    return model.model_validate(doc)
+
+
+@authenticated()
+async def vote_post(info: Info, id: str, vote: Optional[Vote] = None) -> Post:
+    """Votes on a post as the current user, a null vote takes it back."""
+    return (await cast(info, DBPost, "post", id, vote)).gql()
+
+
+@authenticated()
+async def vote_comment(info: Info, id: str, vote: Optional[Vote] = None) -> Comment:
+    """Votes on a comment as the current user, a null vote takes it back."""
+    return (await cast(info, DBComment, "comment", id, vote)).gql()
+
+
+async def get_voters(
+    info: Info,
+    id: str,
+    vote: Optional[Vote] = None,
+    page: int = 1,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    estimate_total: bool = False,
+) -> Page[User]:
+    """Users who voted on a post or comment, latest first."""
+    votes = DBVote.find(DBVote.target_id == PydanticObjectId(id))
+    if vote:
+        votes = votes.find(DBVote.value == vote.value)
+    aggregation_pipe = []
+    total, estimated = 0, False
+    if "total" in selected(info):
+        total, estimated = await count_total(
+            info, votes, aggregation_pipe, estimate=estimate_total
+        )
+
+    page = max(1, page)
+    limit = max(min(100, limit), 1)
+    paginate(aggregation_pipe, SORT_KEYS, cursor, page, limit)
+    votes = await votes.aggregate(aggregation_pipe, projection_model=DBVote).to_list()
+    users = await info.context.user_loader.load_many(
+        [str(vote.user_id) for vote in votes]
+    )
+
+    return Page(
+        total=total,
+        estimated=estimated,
+        next_page=page + 1 if len(votes) == limit and not cursor else None,
+        next_cursor=next_cursor(SORT_KEYS, votes, limit),
+        items=[user for user in users if user],
+    )
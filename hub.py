@@ -0,0 +1,105 @@
+import asyncio
+from collections import Counter, defaultdict
+from typing import Dict, Set, Tuple
+
+from broadcaster import Broadcast
+
+import events
+import metrics
+
+
+def forum_channel(forum_id) -> str:
+    return f"forum:{forum_id}"
+
+
+class Hub:
+    """
+    Per worker fan-out for realtime events. The hub holds a single broadcast
+    subscription per forum channel that at least one local connection needs,
+    decodes each event once and hands it only to the connections following its
+    forum or post.
+
+    Connections need a `topics` (with `forums`, `posts` mapping post to forum,
+    and `events`) and a non blocking `send(event)`. Call `sync` whenever the
+    topics change and `remove` when the connection closes.
+    """
+
+    def __init__(self, broadcast: Broadcast):
+        self.broadcast = broadcast
+        self.forums: Dict[str, Set] = defaultdict(set)
+        self.posts: Dict[str, Set] = defaultdict(set)
+        self.indexed: Dict[object, Tuple[Set[str], Set[str], Set[str]]] = {}
+        self.refs: Counter = Counter()
+        self.listeners: Dict[str, asyncio.Task] = {}
+        metrics.gauge("rte.connections", lambda: len(self.indexed))
+        metrics.gauge("rte.channels", lambda: len(self.listeners))
+
+    def sync(self, conn):
+        forums, posts, channels = self.indexed.get(conn, (set(), set(), set()))
+        new_forums = set(conn.topics.forums)
+        new_posts = set(conn.topics.posts)
+        new_channels = new_forums | set(conn.topics.posts.values())
+        self._reindex(self.forums, conn, forums, new_forums)
+        self._reindex(self.posts, conn, posts, new_posts)
+        for forum in new_channels - channels:
+            self._ref(forum)
+        for forum in channels - new_channels:
+            self._unref(forum)
+        self.indexed[conn] = (new_forums, new_posts, new_channels)
+
+    def remove(self, conn):
+        if conn not in self.indexed:
+            return
+        forums, posts, channels = self.indexed.pop(conn)
+        self._reindex(self.forums, conn, forums, set())
+        self._reindex(self.posts, conn, posts, set())
+        for forum in channels:
+            self._unref(forum)
+
+    def dispatch(self, message: str):
+        metrics.inc("rte.events")
+        event = events.decode(message)
+        conns = self.forums.get(event.forum_id, set()) | self.posts.get(
+            event.post_id, set()
+        )
+        for conn in conns:
+            if event.event in conn.topics.events:
+                metrics.inc("rte.deliveries")
+                conn.send(event)
+
+    def close(self):
+        for task in self.listeners.values():
+            task.cancel()
+        self.listeners.clear()
+
+    @staticmethod
+    def _reindex(index: Dict[str, Set], conn, old: Set[str], new: Set[str]):
+        for key in old - new:
+            index[key].discard(conn)
+            if not index[key]:
+                del index[key]
+        for key in new - old:
+            index[key].add(conn)
+
+    def _ref(self, forum: str):
+        self.refs[forum] += 1
+        if self.refs[forum] == 1:
+            self.listeners[forum] = asyncio.create_task(self._listen(forum))
+
+    def _unref(self, forum: str):
+        self.refs[forum] -= 1
+        if self.refs[forum] <= 0:
+            del self.refs[forum]
+            self.listeners.pop(forum).cancel()
+
+    async def _listen(self, forum: str):
+        async with self.broadcast.subscribe(channel=forum_channel(forum)) as subscriber:
+            try:
+                async for event in subscriber:
+                    try:
+                        self.dispatch(event.message)
+                    except ValueError:
+                        metrics.inc("rte.bad_events")
+            except asyncio.CancelledError:
+                # Leave the block normally, broadcaster only drops the subscriber then
+                pass
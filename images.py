@@ -0,0 +1,114 @@
+import asyncio
+import io
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+from beanie import init_beanie
+from motor.motor_asyncio import AsyncIOMotorClient
+from opendal import AsyncOperator
+from PIL import Image, ImageOps
+from redis import asyncio as aioredis
+
+from models.file import Blob, FileVariant, ImageSize
+from models.forum import DBForum
+from models.post import DBPost
+from models.user import DBUser
+
+QUEUE = "image_jobs"
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif")
+
+log = logging.getLogger("images")
+
+
+async def enqueue(redis: aioredis.Redis, blob: Blob):
+    """Queues variant generation for a freshly uploaded image."""
+    if not blob.variants and blob.loc.endswith(IMAGE_EXTENSIONS):
+        await redis.lpush(QUEUE, blob.digest)
+
+
+def render(data: bytes, side: int) -> Optional[Tuple[bytes, int, int]]:
+    """
+    Resizes an image so its longest side is `side` and encodes it as webp. Runs in
+    the worker's process pool. Returns None when there is nothing to gain.
+    """
+    with Image.open(io.BytesIO(data)) as im:
+        if getattr(im, "is_animated", False) or max(im.size) <= side:
+            return None
+        im = ImageOps.exif_transpose(im)
+        im.thumbnail((side, side))
+        if im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGBA" if "A" in im.getbands() else "RGB")
+        out = io.BytesIO()
+        im.save(out, "WEBP", quality=80, method=4)
+        return out.getvalue(), *im.size
+
+
+async def record(digest: str, variants: List[FileVariant]):
+    """Stores the variants on the blob and on every file embedded with its digest."""
+    docs = [
+        {"size": v.size.value, "loc": v.loc, "width": v.width, "height": v.height}
+        for v in variants
+    ]
+    await Blob.get_motor_collection().update_one(
+        {"digest": digest}, {"$set": {"variants": docs}}
+    )
+    for model, field in (
+        (DBUser, "pfp"),
+        (DBUser, "banner"),
+        (DBForum, "icon"),
+        (DBForum, "banner"),
+    ):
+        await model.get_motor_collection().update_many(
+            {f"{field}.digest": digest}, {"$set": {f"{field}.variants": docs}}
+        )
+    await DBPost.get_motor_collection().update_many(
+        {"attachments.digest": digest},
+        {"$set": {"attachments.$[a].variants": docs}},
+        array_filters=[{"a.digest": digest}],
+    )
+
+
+async def process(operator: AsyncOperator, pool: ProcessPoolExecutor, digest: str):
+    blob = await Blob.find_one(Blob.digest == digest)
+    if not blob or blob.variants:
+        return
+    data = bytes(await operator.read(blob.loc))
+    loop = asyncio.get_running_loop()
+    variants = []
+    for size in ImageSize:
+        res = await loop.run_in_executor(pool, render, data, size.value)
+        if not res:
+            continue
+        bs, width, height = res
+        loc = f"variants/{digest[:2]}/{digest}-{size.name.lower()}.webp"
+        await operator.write(loc, bs)
+        variants.append(FileVariant(size=size, loc=loc, width=width, height=height))
+    if variants:
+        await record(digest, variants)
+    log.info("%s: %d variants", digest, len(variants))
+
+
+async def work():
+    """Generates image variants for queued uploads until stopped."""
+    # main imports this module through the resolvers
+    from main import DOCUMENT_MODELS, op
+
+    client = AsyncIOMotorClient(os.getenv("DB_URL"))
+    await init_beanie(database=client.rtwalk_py, document_models=DOCUMENT_MODELS)
+    redis = aioredis.Redis(
+        host=os.getenv("REDIS_ENDPOINT"), port=int(os.getenv("REDIS_PORT"))
+    )
+    with ProcessPoolExecutor(int(os.getenv("IMAGE_WORKERS", os.cpu_count()))) as pool:
+        while True:
+            _, digest = await redis.brpop(QUEUE)
+            try:
+                await process(op, pool, digest.decode())
+            except Exception:
+                log.exception("Failed to process %s", digest)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(work())
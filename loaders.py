@@ -0,0 +1,36 @@
+from typing import List, Optional
+
+from beanie.odm.fields import PydanticObjectId
+from beanie.operators import In
+
+from models.user import DBUser, User
+from models.vote import DBVote, Vote
+
+
+async def load_users(keys: List[str]) -> List[Optional[User]]:
+    """
+    Batch function for the per-request user loader. Every commenter, poster
+    and owner requested while resolving one operation ends up in a single query.
+    """
+    users = await DBUser.find(In(DBUser.id, [*map(PydanticObjectId, keys)])).to_list()
+    users = {str(user.id): user.gql() for user in users}
+    return [users.get(key) for key in keys]
+
+
+async def load_votes(ctx, keys: List[str]) -> List[Optional[Vote]]:
+    """
+    Batch function for the per-request vote loader, the current user's votes
+    on every post and comment in the response come from a single query.
+    """
+    user = await ctx.user()
+    if not user:
+        return [None] * len(keys)
+    cursor = DBVote.get_motor_collection().find(
+        {
+            "target_id": {"$in": [*map(PydanticObjectId, keys)]},
+            "user_id": PydanticObjectId(user.id),
+        },
+        {"target_id": 1, "value": 1},
+    )
+    votes = {str(vote["target_id"]): Vote(vote["value"]) async for vote in cursor}
+    return [votes.get(key) for key in keys]
@@ -2,8 +2,11 @@ import dotenv
 
 dotenv.load_dotenv()
 
+import asyncio
+import json
 import os
 from contextlib import asynccontextmanager
+from functools import partial
 from typing import Optional
 
 import opendal
@@ -18,16 +21,40 @@ from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 from motor.motor_asyncio import AsyncIOMotorClient
-from strawberry.fastapi import BaseContext, GraphQLRouter
-
-from consts import CDN_ROUTE, ORIGINS, RTE_URL, VC_URL
-from gql import comments, files, forums, posts, subscriptions, users
+from redis import asyncio as aioredis
+from strawberry.dataloader import DataLoader
+from strawberry.extensions import (ParserCache, QueryDepthLimiter,
+                                   ValidationCache)
+from strawberry.fastapi import BaseContext
+
+import metrics
+from cache import EntityCache, LRUCache, ResponseCache, evict_on_broadcast
+from cdn import cdn_app
+from consts import (CDN_ROUTE, DOCUMENT_CACHE_SIZE, ENTITY_CACHE_SIZE,
+                    ENTITY_CACHE_TTL, FEED_FANOUT_LIMIT, FEED_SIZE, FEED_TTL,
+                    MAX_QUERY_DEPTH, ORIGINS, PERSISTED_QUERY_CACHE_SIZE,
+                    PERSISTED_QUERY_TTL, RANKING_SIZE, RESPONSE_CACHE_TTL,
+                    RESPONSE_MAX_AGE, RTE_URL, SEARCH_MAX_FILTERED_HITS,
+                    SEARCH_MAX_HITS, SESSION_CACHE_SIZE, SESSION_CACHE_TTL,
+                    VC_URL)
+from crypto import CryptoPool
+from feed import Feeds
+from gql import (comments, files, follows, forums, posts, subscriptions, users,
+                 votes)
+from gql.cost import QueryCost
+from hub import Hub
+from loaders import load_users, load_votes
 from models.comment import DBComment
+from models.file import Blob
+from models.follow import DBFollow
 from models.forum import DBForum
 from models.post import DBPost
 from models.user import DBUser, User, UserSecret
+from models.vote import DBVote
+from persisted import PersistedQueries, PersistedQueryRouter
+from ranking import Rankings
+from search import AtlasSearch, LocalSearch
 
 MAJOR_V = 0
 MINOR_v = 1
@@ -49,11 +76,81 @@ session = Cache(
     namespace="auth_session",
     ttl=15 * 24 * 60 * 60,
 )
+counts = Cache(
+    Cache.REDIS,
+    endpoint=os.getenv("REDIS_ENDPOINT"),
+    serializer=PickleSerializer(),
+    port=int(os.getenv("REDIS_PORT")),
+    namespace="counts",
+    ttl=30,
+)
+crypto = CryptoPool(
+    workers=int(os.getenv("CRYPTO_WORKERS", 4)),
+    max_concurrency=int(os.getenv("CRYPTO_MAX_CONCURRENCY", 8)),
+)
+# Sessions seen recently by this worker, evicted everywhere on logout
+session_users = LRUCache("sessions", SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL)
+SESSION_CHANNEL = "session_invalidate"
 email_cipher = Fernet(os.getenv("EMAIL_CIPHER_KEY").encode())
 op = opendal.AsyncOperator("fs", root="data/")
+jobs = aioredis.Redis(
+    host=os.getenv("REDIS_ENDPOINT"), port=int(os.getenv("REDIS_PORT"))
+)
 broadcast = Broadcast(
     f'redis://{os.getenv("REDIS_ENDPOINT")}:{os.getenv("REDIS_PORT")}'
 )
+hub = Hub(broadcast)
+search = (
+    AtlasSearch()
+    if os.getenv("SEARCH_ENGINE") == "atlas"
+    else LocalSearch(
+        broadcast,
+        max_hits=SEARCH_MAX_HITS,
+        max_filtered_hits=SEARCH_MAX_FILTERED_HITS,
+    )
+)
+
+entities = EntityCache(
+    Cache(
+        Cache.REDIS,
+        endpoint=os.getenv("REDIS_ENDPOINT"),
+        serializer=PickleSerializer(),
+        port=int(os.getenv("REDIS_PORT")),
+        namespace="entities",
+        ttl=5 * 60,
+    ),
+    broadcast,
+    maxsize=ENTITY_CACHE_SIZE,
+    ttl=ENTITY_CACHE_TTL,
+)
+
+persisted = PersistedQueries(
+    Cache(
+        Cache.REDIS,
+        endpoint=os.getenv("REDIS_ENDPOINT"),
+        port=int(os.getenv("REDIS_PORT")),
+        namespace="persisted_queries",
+    ),
+    maxsize=PERSISTED_QUERY_CACHE_SIZE,
+    ttl=PERSISTED_QUERY_TTL,
+    allowlist=os.getenv("PERSISTED_QUERIES") == "allowlist",
+)
+# Responses to logged out feed queries, shared by every worker
+responses = ResponseCache(jobs, ttl=RESPONSE_CACHE_TTL)
+# Hot and top posts of every forum and of all forums
+rankings = Rankings(jobs, size=RANKING_SIZE)
+feeds = Feeds(jobs, size=FEED_SIZE, fanout_limit=FEED_FANOUT_LIMIT, ttl=FEED_TTL)
+
+DOCUMENT_MODELS = [
+    DBUser,
+    UserSecret,
+    DBForum,
+    DBPost,
+    DBComment,
+    Blob,
+    DBVote,
+    DBFollow,
+]
 
 
 class Ctx(BaseContext):
@@ -61,13 +158,23 @@ class Ctx(BaseContext):
         self.argon2 = ph
         self.pending = pending
         self.session = session
+        self.counts = counts
         self.email_cipher = email_cipher
+        self.crypto = crypto
         self.email_hasher = Scrypt(
             salt=os.getenv("EMAIL_HASH_SALT").encode(), length=32, n=2**14, r=8, p=1
         )
         self.op = op
+        self.jobs = jobs
         self.broadcast = broadcast
+        self.entities = entities
+        self.search = search
+        self.responses = responses
+        self.rankings = rankings
+        self.feeds = feeds
         self.session_user = None
+        self.user_loader = DataLoader(load_fn=load_users)
+        self.vote_loader = DataLoader(load_fn=partial(load_votes, self))
 
     async def user(self) -> Optional[User]:
         if not self.request:
@@ -79,10 +186,13 @@ class Ctx(BaseContext):
         session_token = self.request.cookies.get("session")
         if not session_token:
             return None
-        try:
-            user = User(**(await self.session.get(session_token)))
-        except:
-            return None
+        user = session_users.get(session_token)
+        if not user:
+            try:
+                user = User(**(await self.session.get(session_token)))
+            except:
+                return None
+            session_users.set(session_token, user)
         self.session_user = user
         return user
 
@@ -104,6 +214,10 @@ class Ctx(BaseContext):
             await self.session.delete(session_token)
         except:
             return
+        session_users.pop(session_token)
+        await self.broadcast.publish(
+            channel=SESSION_CHANNEL, message=json.dumps([session_token])
+        )
         self.session_user = None
 
 
@@ -138,6 +252,9 @@ class Query:
     get_posts = strawberry.field(resolver=posts.get_posts)
     get_comment = strawberry.field(resolver=comments.get_comment)
     get_comments = strawberry.field(resolver=comments.get_comments)
+    get_comment_tree = strawberry.field(resolver=comments.get_comment_tree)
+    get_voters = strawberry.field(resolver=votes.get_voters)
+    get_feed = strawberry.field(resolver=follows.get_feed)
 
     @strawberry.field
     def version(self) -> Version:
@@ -154,11 +271,31 @@ class Mutation:
     create_forum = strawberry.field(resolver=forums.create_forum)
     create_post = strawberry.field(resolver=posts.create_post)
     create_comment = strawberry.field(resolver=comments.create_commment)
+    vote_post = strawberry.field(resolver=votes.vote_post)
+    vote_comment = strawberry.field(resolver=votes.vote_comment)
+    follow_forum = strawberry.field(resolver=follows.follow_forum)
+    unfollow_forum = strawberry.field(resolver=follows.unfollow_forum)
     upload_files = strawberry.field(resolver=files.upload_files)
 
 
-schema = strawberry.Schema(query=Query, mutation=Mutation)
-graphql_app = GraphQLRouter(schema, context_getter=lambda: Ctx())
+schema = strawberry.Schema(
+    query=Query,
+    mutation=Mutation,
+    extensions=[
+        ParserCache(maxsize=DOCUMENT_CACHE_SIZE),
+        ValidationCache(maxsize=DOCUMENT_CACHE_SIZE),
+        QueryDepthLimiter(max_depth=MAX_QUERY_DEPTH),
+        # A class, the extension keeps the cost of each request
+        QueryCost,
+    ],
+)
+graphql_app = PersistedQueryRouter(
+    schema,
+    context_getter=lambda: Ctx(),
+    persisted=persisted,
+    responses=responses,
+    max_age=RESPONSE_MAX_AGE,
+)
 
 
 @asynccontextmanager
@@ -167,15 +304,32 @@ async def lifespan(app: FastAPI):
     await broadcast.connect()
     await init_beanie(
         database=client.rtwalk_py,
-        document_models=[DBUser, UserSecret, DBForum, DBPost, DBComment],
+        document_models=DOCUMENT_MODELS,
+    )
+    invalidations = asyncio.create_task(entities.listen())
+    logouts = asyncio.create_task(
+        evict_on_broadcast(broadcast, SESSION_CHANNEL, session_users)
     )
+    indexing = asyncio.create_task(search.listen())
     yield
+    invalidations.cancel()
+    logouts.cancel()
+    indexing.cancel()
+    hub.close()
     await broadcast.disconnect()
+    crypto.shutdown()
+    await jobs.aclose()
     client.close()
 
 
 app = FastAPI(lifespan=lifespan)
 
+
+@app.get("/metrics")
+async def get_metrics():
+    return metrics.snapshot()
+
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=ORIGINS,
@@ -194,6 +348,7 @@ class WsInjectRTE:
             await self.app(scope, receive, send)
             return
         scope["state"]["broadcast"] = broadcast
+        scope["state"]["hub"] = hub
 
         await self.app(scope, receive, send)
 
@@ -204,7 +359,7 @@ app.add_middleware(WsInjectRTE)
 app.include_router(graphql_app, prefix="/api/v1")
 app.include_router(subscriptions.router, prefix="/rte/v1")
 
-app.mount(CDN_ROUTE, StaticFiles(directory="data"), name="cdn")
+app.mount(CDN_ROUTE, cdn_app(op, directory="data"), name="cdn")
 
 if __name__ == "__main__":
     uvicorn.run("main:app", host="127.0.0.1", port=3758, workers=1)
@@ -0,0 +1,266 @@
+import dotenv
+
+dotenv.load_dotenv()
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+from time import time
+from typing import List, Type
+
+from beanie import Document, init_beanie
+from beanie.odm.fields import PydanticObjectId
+from beanie.odm.utils.typing import get_index_attributes
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import IndexModel, UpdateOne
+
+from consts import UPLOAD_CHUNK_SIZE
+from gql.files import extension
+from main import DOCUMENT_MODELS, op, persisted, rankings
+from models.comment import DBComment
+from models.file import Blob, File
+from models.forum import DBForum
+from models.post import DBPost
+from models.user import DBUser
+from models.vote import DBVote
+from ranking import PROJECTION
+
+
+async def digest_of(path: str) -> tuple:
+    reader = await op.open(path, "rb")
+    digest = hashlib.sha256()
+    size = 0
+    while chunk := await reader.read(UPLOAD_CHUNK_SIZE):
+        digest.update(chunk)
+        size += len(chunk)
+    return digest.hexdigest(), size
+
+
+async def relink(old: str, file: File) -> int:
+    """Points every reference to the file at `old` to `file`, returns the count."""
+    fields = {"loc": file.loc, "digest": file.digest, "size": file.size}
+    refs = 0
+    for model, field in (
+        (DBUser, "pfp"),
+        (DBUser, "banner"),
+        (DBForum, "icon"),
+        (DBForum, "banner"),
+    ):
+        res = await model.get_motor_collection().update_many(
+            {f"{field}.loc": old},
+            {"$set": {f"{field}.{k}": v for k, v in fields.items()}},
+        )
+        refs += res.modified_count
+    res = await DBPost.get_motor_collection().update_many(
+        {"attachments.loc": old},
+        {"$set": {f"attachments.$[a].{k}": v for k, v in fields.items()}},
+        array_filters=[{"a.loc": old}],
+    )
+    return refs + res.modified_count
+
+
+async def migrate_files(args):
+    """Moves files uploaded before content addressing into the blob store."""
+    paths = [
+        entry.path
+        async for entry in await op.scan("")
+        if not entry.path.endswith("/")
+        and not entry.path.startswith(("blobs/", "variants/", "tmp/"))
+    ]
+    for path in paths:
+        digest, size = await digest_of(path)
+        tmp = f"tmp/migrate-{PydanticObjectId()}"
+        await op.copy(path, tmp)
+        blob = await Blob.put(op, tmp, digest, size, extension(path))
+        # Uploads were stored as <username>/<ObjectId>-<filename>
+        name = os.path.basename(path).split("-", 1)[-1]
+        refs = await relink(path, blob.file(name))
+        await Blob.find_one(Blob.digest == digest).inc({Blob.refs: refs})
+        if not args.keep:
+            await op.delete(path)
+        print(f"{path} -> {blob.loc} ({refs} references)")
+
+
+async def gc_blobs(args):
+    """Deletes blobs that are unreferenced and were not uploaded recently."""
+    cutoff = int(time()) - args.grace * 60 * 60
+    collected = 0
+    async for blob in Blob.find(Blob.refs <= 0, Blob.uploaded_at < cutoff):
+        res = await Blob.get_motor_collection().delete_one(
+            {"_id": blob.id, "refs": {"$lte": 0}, "uploaded_at": {"$lt": cutoff}}
+        )
+        if res.deleted_count:
+            for loc in [blob.loc, *(variant.loc for variant in blob.variants)]:
+                await op.delete(loc)
+            collected += 1
+    print(f"Collected {collected} blobs")
+
+
+async def migrate_votes(args):
+    """Moves votes embedded in posts and comments into the votes collection."""
+    votes = DBVote.get_motor_collection()
+    for model in (DBPost, DBComment):
+        collection = model.get_motor_collection()
+        migrated = 0
+        async for doc in collection.find(
+            {
+                "$or": [
+                    {"upvoted_by": {"$exists": True}},
+                    {"downvoted_by": {"$exists": True}},
+                ]
+            },
+            {"upvoted_by": 1, "downvoted_by": 1, "created_at": 1},
+        ):
+            ops = [
+                UpdateOne(
+                    {"target_id": doc["_id"], "user_id": user_id},
+                    {"$setOnInsert": {"value": value, "created_at": doc["created_at"]}},
+                    upsert=True,
+                )
+                for value, field in ((1, "upvoted_by"), (-1, "downvoted_by"))
+                for user_id in doc.get(field) or []
+            ]
+            if ops:
+                await votes.bulk_write(ops, ordered=False)
+            # Recount, votes cast while migrating are already in the collection
+            counts = {
+                group["_id"]: group["count"]
+                async for group in votes.aggregate(
+                    [
+                        {"$match": {"target_id": doc["_id"]}},
+                        {"$group": {"_id": "$value", "count": {"$sum": 1}}},
+                    ]
+                )
+            }
+            await collection.update_one(
+                {"_id": doc["_id"]},
+                {
+                    "$set": {
+                        "upvotes": counts.get(1, 0),
+                        "downvotes": counts.get(-1, 0),
+                    },
+                    "$unset": {"upvoted_by": "", "downvoted_by": ""},
+                },
+            )
+            migrated += 1
+        print(f"Migrated votes of {migrated} {model.__name__} documents")
+
+
+async def rank_posts(args):
+    """Rebuilds the hot and top post rankings from the stored counters."""
+    await rankings.clear()
+    batch, ranked = [], 0
+    async for post in DBPost.get_motor_collection().find({}, PROJECTION):
+        batch.append(post)
+        if len(batch) == 1000:
+            await rankings.update(*batch)
+            ranked += len(batch)
+            batch = []
+    if batch:
+        await rankings.update(*batch)
+        ranked += len(batch)
+    print(f"Ranked {ranked} posts")
+
+
+def declared_indexes(model: Type[Document]) -> List[IndexModel]:
+    """Indexes of `Indexed` fields and of the model's Settings."""
+    indexes = [
+        IndexModel([(field.alias or name, attrs[0])], **attrs[1])
+        for name, field in model.model_fields.items()
+        if (attrs := get_index_attributes(field))
+    ]
+    return indexes + getattr(getattr(model, "Settings", None), "indexes", [])
+
+
+async def indexes(args):
+    """Compares declared indexes with the database and reports unused ones."""
+    for model in DOCUMENT_MODELS:
+        settings = getattr(model, "Settings", None)
+        collection = args.db[getattr(settings, "name", model.__name__)]
+        declared = {
+            tuple(index.document["key"].items()): index
+            for index in declared_indexes(model)
+        }
+        live = {
+            tuple(info["key"]): name
+            for name, info in (await collection.index_information()).items()
+        }
+        missing = [index for key, index in declared.items() if key not in live]
+        if missing and args.create:
+            await collection.create_indexes(missing)
+            live.update(
+                (tuple(i.document["key"].items()), i.document["name"]) for i in missing
+            )
+            missing = []
+        stats = {
+            stat["name"]: stat["accesses"]
+            async for stat in collection.aggregate([{"$indexStats": {}}])
+        }
+        print(f"{collection.name}:")
+        for index in missing:
+            print(f"  missing     {index.document['name']}")
+        for key, name in live.items():
+            accesses = stats.get(name, {"ops": 0, "since": None})
+            if name == "_id_":
+                continue
+            if key not in declared:
+                print(f"  undeclared  {name} ({accesses['ops']} ops)")
+            elif not accesses["ops"]:
+                print(f"  unused      {name} (no ops since {accesses['since']})")
+
+
+async def persist_queries(args):
+    """Stores the queries of a manifest for the persisted query allowlist."""
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+    # Either a list of queries or a {sha256: query} object
+    queries = manifest.values() if isinstance(manifest, dict) else manifest
+    for query in queries:
+        await persisted.add(query, allowed=True)
+    print(f"{len(queries)} queries persisted")
+
+
+async def run(args):
+    client = AsyncIOMotorClient(os.getenv("DB_URL"))
+    args.db = client.rtwalk_py
+    # Initializing beanie also creates every declared index
+    if args.init:
+        await init_beanie(database=args.db, document_models=DOCUMENT_MODELS)
+    try:
+        await args.command(args)
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RtWalk maintenance commands")
+    parser.set_defaults(init=True)
+    commands = parser.add_subparsers(required=True)
+
+    cmd = commands.add_parser("migrate-files", help=migrate_files.__doc__)
+    cmd.add_argument("--keep", action="store_true", help="Keep the original files")
+    cmd.set_defaults(command=migrate_files)
+
+    cmd = commands.add_parser("gc-blobs", help=gc_blobs.__doc__)
+    cmd.add_argument(
+        "--grace", type=int, default=24, help="Hours an unreferenced blob is kept"
+    )
+    cmd.set_defaults(command=gc_blobs)
+
+    cmd = commands.add_parser("migrate-votes", help=migrate_votes.__doc__)
+    cmd.set_defaults(command=migrate_votes)
+
+    cmd = commands.add_parser("rank-posts", help=rank_posts.__doc__)
+    cmd.set_defaults(command=rank_posts)
+
+    cmd = commands.add_parser("indexes", help=indexes.__doc__)
+    cmd.add_argument("--create", action="store_true", help="Create the missing indexes")
+    cmd.set_defaults(command=indexes, init=False)
+
+    cmd = commands.add_parser("persist-queries", help=persist_queries.__doc__)
+    cmd.add_argument("manifest", help="JSON file of the queries the frontend sends")
+    cmd.set_defaults(command=persist_queries, init=False)
+
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,18 @@
+from collections import defaultdict
+from typing import Callable, Dict
+
+counters: Dict[str, int] = defaultdict(int)
+gauges: Dict[str, Callable[[], float]] = {}
+
+
+def inc(name: str, value: int = 1):
+    counters[name] += value
+
+
+def gauge(name: str, fn: Callable[[], float]):
+    """Registers a value read lazily whenever metrics are collected."""
+    gauges[name] = fn
+
+
+def snapshot() -> Dict[str, float]:
+    return {**counters, **{name: fn() for name, fn in gauges.items()}}
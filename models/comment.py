@@ -1,14 +1,17 @@
 from __future__ import annotations
 
 from time import time
-from typing import Annotated, List, Optional
+from typing import List, Optional
 
 import strawberry
-from beanie import Document, Link
+from beanie import Document
 from beanie.odm.fields import PydanticObjectId
 from pydantic import Field
+from pymongo import IndexModel
+from strawberry.types import Info
 
-from models.user import DBUser, User
+from models.user import User
+from models.vote import Vote
 
 
 @strawberry.type
@@ -19,14 +22,27 @@ class Comment:
     reply_to: Optional[str]
     post_id: str
     forum_id: str
-    commenter: Annotated[User, strawberry.lazy(".user")]
     created_at: int
     modified_at: int
     reply_count: int
     upvotes: int
     downvotes: int
-    upvoted_by: List[str]
-    downvoted_by: List[str]
+
+    @strawberry.field
+    async def commenter(self, info: Info) -> User:
+        return await info.context.user_loader.load(self.commenter_id)
+
+    @strawberry.field
+    async def viewer_vote(self, info: Info) -> Optional[Vote]:
+        return await info.context.vote_loader.load(self.id)
+
+
+@strawberry.type
+class CommentNode:
+    comment: Comment
+    replies: List[CommentNode]
+    # Replies exist beyond the ones loaded, page them with getComments(replyTo)
+    more_replies: bool
 
 
 class DBComment(Document):
@@ -35,14 +51,36 @@ class DBComment(Document):
     reply_to: Optional[PydanticObjectId] = None
     post_id: PydanticObjectId
     forum_id: PydanticObjectId
-    commenter: Optional[Link[DBUser]] = None  # Createtion guarrentes it to be populated
     created_at: int = Field(default_factory=lambda: int(time()))
     modified_at: int = Field(default_factory=lambda: int(time()))
     reply_count: int = 0
     upvotes: int = 0
     downvotes: int = 0
-    upvoted_by: List[PydanticObjectId] = Field(default=[])
-    downvoted_by: List[PydanticObjectId] = Field(default=[])
+
+    class Settings:
+        # Filters and orders built by gql/comments.py, indexes are walked both ways
+        indexes = [
+            IndexModel([("post_id", 1), ("_id", 1)]),
+            IndexModel([("post_id", 1), ("created_at", 1), ("_id", 1)]),
+            IndexModel([("post_id", 1), ("upvotes", -1), ("_id", -1)]),
+            IndexModel([("post_id", 1), ("downvotes", -1), ("_id", -1)]),
+            IndexModel([("post_id", 1), ("reply_to", 1), ("_id", 1)]),
+            IndexModel(
+                [("post_id", 1), ("reply_to", 1), ("created_at", 1), ("_id", 1)]
+            ),
+            IndexModel([("post_id", 1), ("reply_to", 1), ("upvotes", -1), ("_id", -1)]),
+            IndexModel(
+                [("post_id", 1), ("reply_to", 1), ("downvotes", -1), ("_id", -1)]
+            ),
+            IndexModel([("reply_to", 1), ("_id", 1)]),
+            IndexModel([("reply_to", 1), ("created_at", 1), ("_id", 1)]),
+            IndexModel([("reply_to", 1), ("upvotes", -1), ("_id", -1)]),
+            IndexModel([("reply_to", 1), ("downvotes", -1), ("_id", -1)]),
+            IndexModel([("commenter_id", 1), ("_id", 1)]),
+            IndexModel([("commenter_id", 1), ("created_at", 1), ("_id", 1)]),
+            IndexModel([("commenter_id", 1), ("upvotes", -1), ("_id", -1)]),
+            IndexModel([("commenter_id", 1), ("downvotes", -1), ("_id", -1)]),
+        ]
 
     def gql(self) -> Comment:
         return Comment(
@@ -52,12 +90,9 @@ class DBComment(Document):
             reply_to=str(self.reply_to) if self.reply_to else None,
             post_id=str(self.post_id),
             forum_id=str(self.forum_id),
-            commenter=self.commenter.gql(),
             created_at=self.created_at,
             modified_at=self.modified_at,
             reply_count=self.reply_count,
-            upvoted_by=list(map(str, self.upvoted_by)),
-            downvoted_by=list(map(str, self.downvoted_by)),
             upvotes=self.upvotes,
             downvotes=self.downvotes,
         )
@@ -1,14 +1,52 @@
 import os
+from enum import Enum
+from time import time
+from typing import List, Optional
 
 import strawberry
+from beanie import Document, Indexed
 from opendal import AsyncOperator
+from pydantic import Field
+from pymongo import IndexModel, ReturnDocument
 
 CDN_PREFIX = os.getenv("CDN")
 
 
+@strawberry.enum
+class ImageSize(Enum):
+    """Size classes images are resized to, the value is the longest side in px."""
+
+    SMALL = 96
+    MEDIUM = 480
+    LARGE = 1280
+
+
+@strawberry.type
+class FileVariant:
+    size: ImageSize
+    loc: str
+    width: int
+    height: int
+
+
 @strawberry.type
 class File:
     loc: str
+    digest: Optional[str] = None
+    name: Optional[str] = None
+    size: Optional[int] = None
+    variants: Optional[List[FileVariant]] = None
+
+    @strawberry.field
+    def loc_for(self, size: ImageSize) -> str:
+        """
+        Location of the image resized to `size`. Falls back to the original while
+        the variant is being generated, or when the original is already smaller.
+        """
+        for variant in self.variants or []:
+            if variant.size == size:
+                return variant.loc
+        return self.loc
 
     # @strawberry.field
     # def absolute_path(self) -> str:
@@ -16,3 +54,59 @@ class File:
 
     async def save(self, operator: AsyncOperator, bs: bytes):
         await operator.write(self.loc, bs)
+
+
+class Blob(Document):
+    """
+    Stored content, addressed by its sha256 digest. `refs` counts the posts,
+    users and forums referencing the blob, blobs nobody referenced for a while
+    are garbage collected.
+    """
+
+    digest: Indexed(str, unique=True)
+    loc: Indexed(str)
+    size: int
+    refs: int = 0
+    variants: List[FileVariant] = Field(default=[])
+    uploaded_at: int = Field(default_factory=lambda: int(time()))
+
+    class Settings:
+        indexes = [
+            IndexModel([("refs", 1), ("uploaded_at", 1)]),
+        ]
+
+    @staticmethod
+    def path(digest: str, ext: str = "") -> str:
+        return f"blobs/{digest[:2]}/{digest}{ext}"
+
+    @classmethod
+    async def put(
+        cls, operator: AsyncOperator, tmp: str, digest: str, size: int, ext: str
+    ) -> "Blob":
+        """
+        Moves the file at `tmp` into the blob store, keeping the already stored
+        copy when the same content was uploaded before.
+        """
+        loc = cls.path(digest, ext)
+        await operator.rename(tmp, loc)
+        blob = await cls.get_motor_collection().find_one_and_update(
+            {"digest": digest},
+            {
+                "$set": {"uploaded_at": int(time())},
+                "$setOnInsert": {"loc": loc, "size": size, "refs": 0},
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        if blob["loc"] != loc:
+            await operator.delete(loc)
+        return cls.model_validate(blob)
+
+    def file(self, name: Optional[str] = None) -> File:
+        return File(
+            loc=self.loc,
+            digest=self.digest,
+            name=name,
+            size=self.size,
+            variants=self.variants or None,
+        )
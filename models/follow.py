@@ -0,0 +1,23 @@
+from time import time
+
+from beanie import Document
+from beanie.odm.fields import PydanticObjectId
+from pydantic import Field
+from pymongo import IndexModel
+
+
+class DBFollow(Document):
+    """
+    A user following a forum. The forum keeps `follower_count` in sync, follows
+    are read for the user's feed and for the followers new posts are pushed to.
+    """
+
+    user_id: PydanticObjectId
+    forum_id: PydanticObjectId
+    created_at: int = Field(default_factory=lambda: int(time()))
+
+    class Settings:
+        indexes = [
+            IndexModel([("user_id", 1), ("forum_id", 1)], unique=True),
+            IndexModel([("forum_id", 1), ("user_id", 1)]),
+        ]
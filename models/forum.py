@@ -5,8 +5,11 @@ import strawberry
 from beanie import Document, Indexed
 from beanie.odm.fields import PydanticObjectId
 from pydantic import Field
+from pymongo import IndexModel
+from strawberry.types import Info
 
 from models.file import File
+from models.user import User
 
 
 @strawberry.type
@@ -18,6 +21,7 @@ class Forum:
     icon: Optional[File]
     banner: Optional[File]
     post_count: int
+    follower_count: int
     created_at: int
     modified_at: int
     owner_id: str
@@ -25,6 +29,10 @@ class Forum:
     banned_members: List[str]
     locked: bool
 
+    @strawberry.field
+    async def owner(self, info: Info) -> User:
+        return await info.context.user_loader.load(self.owner_id)
+
 
 class DBForum(Document):
     name: Indexed(str, unique=True)
@@ -33,6 +41,7 @@ class DBForum(Document):
     icon: Optional[File] = None
     banner: Optional[File] = None
     post_count: int = 0
+    follower_count: int = 0
     created_at: int = Field(default_factory=lambda: int(time()))
     modified_at: int = Field(default_factory=lambda: int(time()))
     owner_id: PydanticObjectId
@@ -40,6 +49,15 @@ class DBForum(Document):
     banned_members: List[PydanticObjectId] = Field(default=[])
     locked: bool = False
 
+    class Settings:
+        indexes = [
+            IndexModel([("created_at", 1), ("_id", 1)]),
+            IndexModel([("owner_id", 1), ("_id", 1)]),
+            IndexModel([("owner_id", 1), ("created_at", 1), ("_id", 1)]),
+            IndexModel([("icon.digest", 1)], sparse=True),
+            IndexModel([("banner.digest", 1)], sparse=True),
+        ]
+
     def gql(self) -> Forum:
         return Forum(
             id=str(self.id),
@@ -49,9 +67,10 @@ class DBForum(Document):
             icon=self.icon,
             banner=self.banner,
             post_count=self.post_count,
+            follower_count=self.follower_count,
             created_at=self.created_at,
             modified_at=self.modified_at,
-            owner_id=self.owner_id,
+            owner_id=str(self.owner_id),
             moderators=list(map(str, self.moderators)),
             banned_members=list(map(str, self.banned_members)),
             locked=self.locked,
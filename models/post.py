@@ -5,8 +5,12 @@ import strawberry
 from beanie import Document
 from beanie.odm.fields import PydanticObjectId
 from pydantic import BaseModel, Field
+from pymongo import IndexModel
+from strawberry.types import Info
 
 from models.file import File
+from models.user import User
+from models.vote import Vote
 
 
 @strawberry.type
@@ -38,11 +42,31 @@ class Post:
     forum_id: str
     upvotes: int
     downvotes: int
-    upvoted_by: List[str]
-    downvoted_by: List[str]
     pinned: bool
     rolling: bool
 
+    @strawberry.field
+    async def poster(self, info: Info) -> User:
+        return await info.context.user_loader.load(self.poster_id)
+
+    @strawberry.field
+    async def viewer_vote(self, info: Info) -> Optional[Vote]:
+        return await info.context.vote_loader.load(self.id)
+
+
+# Filters of post listings: global, forum, poster and tag
+LISTINGS = [[], [("forum_id", 1)], [("poster_id", 1)], [("tags", 1)]]
+# PostSort orders after pinned, with the direction of their _id tiebreaker
+ORDERS = [
+    [-1],
+    [("created_at", -1), -1],
+    [("created_at", 1), 1],
+    [("modified_at", -1), -1],
+    [("modified_at", 1), 1],
+    [("upvotes", -1), -1],
+    [("downvotes", -1), -1],
+]
+
 
 class DBPost(Document):
     title: str
@@ -58,11 +82,22 @@ class DBPost(Document):
     forum_id: PydanticObjectId
     upvotes: int = 0
     downvotes: int = 0
-    upvoted_by: List[PydanticObjectId] = Field(default=[])
-    downvoted_by: List[PydanticObjectId] = Field(default=[])
     pinned: bool = False
     rolling: bool = False
 
+    class Settings:
+        # Filters and orders built by gql/posts.py: every listing supports every
+        # order, each led by pinned and ended by _id in the direction of its last key
+        indexes = [
+            IndexModel([*listing, ("pinned", -1), *order, ("_id", direction)])
+            for listing in LISTINGS
+            for *order, direction in ORDERS
+        ] + [
+            # Latest posts of the followed forums, merged by feed.py
+            IndexModel([("forum_id", 1), ("_id", -1)]),
+            IndexModel([("attachments.digest", 1)], sparse=True),
+        ]
+
     def gql(self) -> Post:
         return Post(
             id=str(self.id),
@@ -85,12 +120,10 @@ class DBPost(Document):
             participants=list(map(str, self.participants)),
             created_at=self.created_at,
             modified_at=self.modified_at,
-            poster_id=self.poster_id,
-            forum_id=self.forum_id,
+            poster_id=str(self.poster_id),
+            forum_id=str(self.forum_id),
             upvotes=self.upvotes,
             downvotes=self.downvotes,
-            upvoted_by=list(map(str, self.upvoted_by)),
-            downvoted_by=list(map(str, self.downvoted_by)),
             pinned=self.pinned,
             rolling=self.rolling,
         )
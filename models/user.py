@@ -5,6 +5,7 @@ import strawberry
 from beanie import Document, Indexed
 from beanie.odm.fields import PydanticObjectId
 from pydantic import Field
+from pymongo import IndexModel
 
 from models.file import File
 
@@ -19,6 +20,7 @@ class User:
     banner: Optional[File] = None
     stars: int = 0
     starred_by: List[str]
+    post_count: int = 0
     created_at: int
     modified_at: int
     admin: bool = False
@@ -40,12 +42,20 @@ class DBUser(Document):
     banner: Optional[File] = None
     stars: int = 0
     starred_by: List[PydanticObjectId] = []
+    post_count: int = 0
     created_at: int = Field(default_factory=lambda: int(time()))
     modified_at: int = Field(default_factory=lambda: int(time()))
     admin: bool = False
     bot: bool = False
     bot_owner: Optional[PydanticObjectId] = None
 
+    class Settings:
+        indexes = [
+            IndexModel([("created_at", 1), ("_id", 1)]),
+            IndexModel([("pfp.digest", 1)], sparse=True),
+            IndexModel([("banner.digest", 1)], sparse=True),
+        ]
+
     def gql(self) -> User:
         return User(
             id=str(self.id),
@@ -56,6 +66,7 @@ class DBUser(Document):
             banner=self.banner,
             stars=self.stars,
             starred_by=self.starred_by,
+            post_count=self.post_count,
             created_at=self.created_at,
             modified_at=self.modified_at,
             admin=self.admin,
@@ -0,0 +1,33 @@
+from enum import Enum
+from time import time
+
+import strawberry
+from beanie import Document
+from beanie.odm.fields import PydanticObjectId
+from pydantic import Field
+from pymongo import IndexModel
+
+
+@strawberry.enum
+class Vote(Enum):
+    UP = 1
+    DOWN = -1
+
+
+class DBVote(Document):
+    """
+    A user's vote on a post or comment. The target keeps `upvotes` and
+    `downvotes` counters in sync, the votes themselves are only read for the
+    viewer's own vote and for voter lists.
+    """
+
+    target_id: PydanticObjectId
+    user_id: PydanticObjectId
+    value: int
+    created_at: int = Field(default_factory=lambda: int(time()))
+
+    class Settings:
+        indexes = [
+            IndexModel([("target_id", 1), ("user_id", 1)], unique=True),
+            IndexModel([("target_id", 1), ("created_at", -1), ("_id", -1)]),
+        ]
@@ -0,0 +1,245 @@
+"""
+Persisted queries for the GraphQL router.
+
+Clients following the automatic persisted queries protocol send the sha256 of
+a query in `extensions.persistedQuery.sha256Hash` instead of its text. An
+unknown hash is answered with a `PersistedQueryNotFound` error, the client
+then retries once with the text and the hash, which registers the query.
+Queries live in Redis and in an LRU of every worker.
+
+In allowlist mode clients can't register queries, only the ones stored ahead
+of time with `python manage.py persist-queries` are executed, whether they are
+sent by hash or as text. They are kept apart from the queries clients
+registered, which an allowlist never executes.
+
+Persisted feed queries sent by GET without a session are the same for every
+client, their responses are shared through the response cache and can be
+cached by proxies for a few seconds.
+"""
+
+import json
+from functools import lru_cache
+from hashlib import sha1, sha256
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+from aiocache import Cache
+from graphql import FieldNode, GraphQLError, OperationType, parse
+from graphql.utilities import get_operation_ast
+from starlette.requests import Request
+from starlette.responses import Response
+from strawberry.fastapi import GraphQLRouter
+from strawberry.http import GraphQLRequestData
+from strawberry.http.async_base_view import AsyncHTTPRequestAdapter
+from strawberry.http.exceptions import HTTPException
+from strawberry.types import ExecutionResult
+from strawberry.unset import UNSET
+
+from cache import LRUCache, ResponseCache
+from cdn import matches
+from consts import PERSISTED_QUERY_CACHE_SIZE
+from error import PersistedQueryError, PersistedQueryErrorType
+
+# Root fields answering the same to every logged out client
+CACHEABLE = {"getPosts", "getForums", "getComments", "getCommentTree", "__typename"}
+# Variables naming what a response shows, other responses are purged by any change
+TAGS = {"forumId": "forum", "postId": "post"}
+# Key prefix of allowlisted queries, client registered ones are under their hash
+ALLOWED = "allowed:"
+
+
+def digest(query: str) -> str:
+    return sha256(query.encode()).hexdigest()
+
+
+@lru_cache(maxsize=PERSISTED_QUERY_CACHE_SIZE)
+def root_fields(query: str, operation_name: Optional[str]) -> FrozenSet[str]:
+    """Fields a query operation selects on `Query`, empty for anything else."""
+    try:
+        operation = get_operation_ast(parse(query), operation_name)
+    except GraphQLError:
+        return frozenset()
+    if operation is None or operation.operation != OperationType.QUERY:
+        return frozenset()
+    selections = operation.selection_set.selections
+    if not all(isinstance(selection, FieldNode) for selection in selections):
+        return frozenset()
+    return frozenset(selection.name.value for selection in selections)
+
+
+class PersistedQueries:
+    def __init__(
+        self, remote: Cache, maxsize: int, ttl: Optional[int], allowlist: bool
+    ):
+        self.local = LRUCache("persisted_queries", maxsize)
+        self.remote = remote
+        # How long queries registered by clients are kept, allowlisted ones stay
+        self.ttl = ttl
+        self.allowlist = allowlist
+
+    async def get(self, hash: str) -> Optional[str]:
+        """The query of a hash, only allowlisted ones in allowlist mode."""
+        # A worker never changes mode, its local copies are of the right kind
+        query = self.local.get(hash)
+        if query is None:
+            keys = [ALLOWED + hash] if self.allowlist else [hash, ALLOWED + hash]
+            for key in keys:
+                query = await self.remote.get(key)
+                if query is not None:
+                    self.local.set(hash, query)
+                    break
+        return query
+
+    async def add(
+        self, query: str, ttl: Optional[int] = None, allowed: bool = False
+    ) -> str:
+        hash = digest(query)
+        await self.remote.set(ALLOWED + hash if allowed else hash, query, ttl=ttl)
+        if allowed or not self.allowlist:
+            self.local.set(hash, query)
+        return hash
+
+    async def resolve(
+        self, query: Optional[str], extensions: Optional[Dict[str, Any]]
+    ) -> Optional[str]:
+        """The query text of a request, looked up or registered by its hash."""
+        persisted = (extensions or {}).get("persistedQuery")
+        hash = persisted.get("sha256Hash") if isinstance(persisted, dict) else None
+        if query is None:
+            if hash is None:
+                return None
+            query = await self.get(hash)
+            if query is None:
+                # Retrying with the text wouldn't help with an allowlist
+                if self.allowlist:
+                    raise PersistedQueryError(
+                        "PersistedQueryNotAllowed",
+                        tp=PersistedQueryErrorType.PERSISTED_QUERY_NOT_ALLOWED,
+                    )
+                raise PersistedQueryError(
+                    "PersistedQueryNotFound",
+                    tp=PersistedQueryErrorType.PERSISTED_QUERY_NOT_FOUND,
+                )
+            return query
+        if hash is not None and hash != digest(query):
+            raise PersistedQueryError(
+                "Provided sha does not match query",
+                tp=PersistedQueryErrorType.PROVIDED_SHA_DOES_NOT_MATCH,
+            )
+        if self.allowlist:
+            if await self.get(hash or digest(query)) is None:
+                raise PersistedQueryError(
+                    "PersistedQueryNotAllowed",
+                    tp=PersistedQueryErrorType.PERSISTED_QUERY_NOT_ALLOWED,
+                )
+        elif hash is not None:
+            await self.add(query, ttl=self.ttl)
+        return query
+
+
+class PersistedQueryRouter(GraphQLRouter):
+    """GraphQL router resolving persisted queries before execution."""
+
+    def __init__(
+        self,
+        *args,
+        persisted: PersistedQueries,
+        responses: Optional[ResponseCache] = None,
+        max_age: int = 0,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.persisted = persisted
+        self.responses = responses
+        # Seconds proxies and browsers may reuse a shared response
+        self.max_age = max_age
+
+    async def shared(self, request: Request) -> Optional[Tuple[str, List[str]]]:
+        """Cache key and tags of a request answered the same to everyone."""
+        if (
+            self.responses is None
+            or request.method != "GET"
+            or "session" in request.cookies
+        ):
+            return None
+        params = request.query_params
+        try:
+            extensions = json.loads(params.get("extensions") or "{}")
+            variables = json.loads(params.get("variables") or "{}")
+            hash = extensions["persistedQuery"]["sha256Hash"]
+        except (ValueError, TypeError, KeyError):
+            return None
+        if not isinstance(hash, str) or not isinstance(variables, dict):
+            return None
+        query = await self.persisted.get(hash)
+        if query is None:
+            return None
+        fields = root_fields(query, params.get("operationName"))
+        if not fields or not fields <= CACHEABLE:
+            return None
+        tags = [
+            f"{TAGS[name]}:{value}"
+            for name, value in variables.items()
+            if name in TAGS and isinstance(value, str)
+        ]
+        key = ResponseCache.key(hash, params.get("operationName"), variables)
+        return key, tags or [ResponseCache.ALL]
+
+    async def run(
+        self, request: Request, context: Any = UNSET, root_value: Any = UNSET
+    ) -> Response:
+        shared = await self.shared(request)
+        if shared is None:
+            return await super().run(request, context, root_value)
+        key, tags = shared
+        body = await self.responses.get(key)
+        if body is None:
+            response = await super().run(request, context, root_value)
+            if response.status_code != 200 or "errors" in json.loads(response.body):
+                return response
+            body = response.body
+            await self.responses.set(key, body, tags)
+        etag = f'"{sha1(body).hexdigest()}"'
+        headers = {
+            "cache-control": f"public, max-age={self.max_age}",
+            "etag": etag,
+            "vary": "Cookie",
+        }
+        if matches(request.headers.get("if-none-match", ""), etag):
+            return Response(status_code=304, headers=headers)
+        return Response(body, media_type="application/json", headers=headers)
+
+    def should_render_graphql_ide(self, request: AsyncHTTPRequestAdapter) -> bool:
+        # Persisted queries sent by GET have no `query` either
+        return (
+            "extensions" not in request.query_params
+            and super().should_render_graphql_ide(request)
+        )
+
+    async def parse_http_body(
+        self, request: AsyncHTTPRequestAdapter
+    ) -> GraphQLRequestData:
+        content_type = request.content_type or ""
+        if "application/json" in content_type:
+            data = self.parse_json(await request.get_body())
+        elif content_type.startswith("multipart/form-data"):
+            data = await self.parse_multipart(request)
+        elif request.method == "GET":
+            data = self.parse_query_params(request.query_params)
+        else:
+            raise HTTPException(400, "Unsupported content type")
+        extensions = data.get("extensions")
+        if isinstance(extensions, list):
+            extensions = extensions[0]
+        if isinstance(extensions, str):
+            extensions = self.parse_json(extensions)
+        return GraphQLRequestData(
+            query=await self.persisted.resolve(data.get("query"), extensions),
+            variables=data.get("variables"),
+            operation_name=data.get("operationName"),
+        )
+
+    async def execute_operation(self, request, context, root_value) -> ExecutionResult:
+        try:
+            return await super().execute_operation(request, context, root_value)
+        except PersistedQueryError as e:
+            return ExecutionResult(data=None, errors=[e.into()])
@@ -0,0 +1,134 @@
+"""
+Hot and top post rankings kept in Redis sorted sets, one per forum and one
+across forums, updated whenever a post is created, voted on or commented.
+
+Hot scores never decay in place: a post's activity is scored on a log scale
+and offset by its creation time, so a newer post outranks an older one unless
+the older one has ten times the activity per HOT_DECAY seconds between them.
+That is the order of an exponentially decaying score, without rewriting old
+entries as time passes.
+
+Each set keeps the best `size` posts, later pages of a ranking are empty.
+"""
+
+import math
+from typing import Any, List, NamedTuple, Optional
+
+from pydantic import BaseModel
+from redis import asyncio as aioredis
+
+from error import InvalidGetQuery
+from gql.pagination import decode_cursor, encode_cursor
+
+# Seconds of age that take ten times the activity to make up for
+HOT_DECAY = 45_000
+# A comment counts as much as this many votes
+COMMENT_WEIGHT = 0.5
+# Post fields the scores are computed from
+PROJECTION = {
+    "forum_id": 1,
+    "created_at": 1,
+    "upvotes": 1,
+    "downvotes": 1,
+    "comment_count": 1,
+}
+CURSOR_KEYS = [("score", -1), ("_id", -1)]
+
+
+class Entry(NamedTuple):
+    id: str
+    score: float
+
+
+def hot(votes: int, comments: int, created_at: int) -> float:
+    activity = votes + comments * COMMENT_WEIGHT
+    sign = (activity > 0) - (activity < 0)
+    return sign * math.log10(max(abs(activity), 1)) + created_at / HOT_DECAY
+
+
+def top(votes: int, created_at: int) -> float:
+    # The fraction orders equal votes newest first, so scores rarely tie
+    return votes + created_at / 1e10
+
+
+class Rankings:
+    def __init__(self, redis: aioredis.Redis, size: int):
+        self.redis = redis
+        self.size = size
+
+    @staticmethod
+    def key(kind: str, forum_id: Optional[Any] = None) -> str:
+        return f"rank:{kind}:{forum_id}" if forum_id else f"rank:{kind}"
+
+    async def update(self, *posts: Any):
+        """Scores posts, or raw mongo documents of them, from their counters."""
+        keys = set()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for post in posts:
+                if isinstance(post, BaseModel):
+                    post = post.model_dump(by_alias=True)
+                votes = post.get("upvotes", 0) - post.get("downvotes", 0)
+                scores = {
+                    "hot": hot(votes, post.get("comment_count", 0), post["created_at"]),
+                    "top": top(votes, post["created_at"]),
+                }
+                for kind, score in scores.items():
+                    for key in (self.key(kind), self.key(kind, post["forum_id"])):
+                        pipe.zadd(key, {str(post["_id"]): score})
+                        keys.add(key)
+            for key in keys:
+                pipe.zremrangebyrank(key, 0, -self.size - 1)
+            await pipe.execute()
+
+    async def page(
+        self,
+        kind: str,
+        forum_id: Optional[str],
+        page: int,
+        limit: int,
+        cursor: Optional[str] = None,
+    ) -> List[Entry]:
+        key = self.key(kind, forum_id)
+        if cursor:
+            score, last = decode_cursor(CURSOR_KEYS, cursor)
+            if not isinstance(score, (int, float)):
+                raise InvalidGetQuery().gql()
+            return await self.after(key, score, str(last), limit)
+        start = (page - 1) * limit
+        entries = await self.redis.zrevrange(
+            key, start, start + limit - 1, withscores=True
+        )
+        return [Entry(id.decode(), score) for id, score in entries]
+
+    async def after(self, key: str, score: float, last: str, limit: int) -> List[Entry]:
+        """
+        Entries ranked after `(score, last)`. Ties on the score are ordered by id
+        like the cursor, so they are read from the score inclusive and skipped
+        up to `last`.
+        """
+        entries = []
+        offset = 0
+        while len(entries) < limit:
+            batch = await self.redis.zrevrangebyscore(
+                key, score, "-inf", start=offset, num=limit, withscores=True
+            )
+            for id, value in batch:
+                id = id.decode()
+                if value < score or id < last:
+                    entries.append(Entry(id, value))
+            if len(batch) < limit:
+                break
+            offset += limit
+        return entries[:limit]
+
+    @staticmethod
+    def next_cursor(entries: List[Entry], limit: int) -> Optional[str]:
+        if len(entries) < limit:
+            return None
+        return encode_cursor(CURSOR_KEYS, entries[-1])
+
+    async def clear(self):
+        """Drops every ranking, before they are rebuilt."""
+        keys = [key async for key in self.redis.scan_iter(match="rank:*")]
+        if keys:
+            await self.redis.delete(*keys)
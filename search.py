@@ -0,0 +1,365 @@
+"""
+Full-text search behind the `search` argument of the list queries.
+
+`AtlasSearch` uses the `$search` stage, which only exists on MongoDB Atlas.
+`LocalSearch` keeps an inverted index per searchable collection in every
+worker: text is tokenized, matched exactly, by prefix and with one typo, and
+ranked with BM25. Workers load the index on startup and keep it current with
+the documents mutations publish on the broadcast.
+
+Either engine turns a query, and the filters of the list it searches, into
+pipeline stages keeping the matching documents, best match first. The local
+engine reads the ids the filters keep and ranks them itself, so only the ranks
+of the documents up to the requested page are sent to the database.
+"""
+
+import asyncio
+import heapq
+import json
+import logging
+import math
+import re
+import string
+import unicodedata
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from beanie.odm.fields import PydanticObjectId
+from beanie.odm.queries.find import FindMany
+from broadcaster import Broadcast
+from pydantic import BaseModel
+
+import metrics
+from models.comment import DBComment
+from models.forum import DBForum
+from models.post import DBPost
+from models.user import DBUser
+
+# Searched fields of each collection with their weight
+FIELDS = {
+    "users": {"username": 2, "display_name": 2, "bio": 1},
+    "forums": {"name": 2, "display_name": 2, "description": 1},
+    "posts": {"title": 3, "tags": 2, "content": 1, "poll.options": 1},
+    "comments": {"content": 1},
+}
+MODELS = {"users": DBUser, "forums": DBForum, "posts": DBPost, "comments": DBComment}
+
+log = logging.getLogger("search")
+
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have in is it its of on or that "
+    "the this to was were will with".split()
+)
+TOKEN = re.compile(r"\w+")
+MAX_TOKEN = 32
+ALPHABET = string.ascii_lowercase + string.digits
+# Relative weight of terms that only match a query token by prefix or typo
+PREFIX_WEIGHT = 0.6
+FUZZY_WEIGHT = 0.4
+MAX_EXPANSIONS = 32
+# New terms kept apart from the sorted vocabulary before they are merged in
+TAIL_SIZE = 1024
+# Terms with more postings only rescore documents rarer terms already found, or
+# the most recent documents when the query has nothing rarer
+PRUNE_AT = 5_000
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text: str) -> List[str]:
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [
+        token[:MAX_TOKEN] for token in TOKEN.findall(text) if token not in STOPWORDS
+    ]
+
+
+def edits(token: str) -> Iterable[str]:
+    """Every string one deletion, transposition, substitution or insertion away."""
+    splits = [(token[:i], token[i:]) for i in range(len(token) + 1)]
+    for left, right in splits:
+        if right:
+            yield left + right[1:]
+            for c in ALPHABET:
+                yield left + c + right[1:]
+        if len(right) > 1:
+            yield left + right[1] + right[0] + right[2:]
+        for c in ALPHABET:
+            yield left + c + right
+
+
+def text_fields(kind: str, doc: Any) -> Dict[str, str]:
+    """Text of the searched fields of a document or a raw mongo document."""
+    if isinstance(doc, BaseModel):
+        doc = doc.model_dump()
+    fields = {}
+    for path in FIELDS[kind]:
+        value = doc
+        for part in path.split("."):
+            value = value.get(part) if isinstance(value, dict) else None
+        if isinstance(value, list):
+            value = " ".join(map(str, value))
+        if value:
+            fields[path] = str(value)
+    return fields
+
+
+class InvertedIndex:
+    """
+    BM25 ranked inverted index over documents of weighted text fields.
+
+    Postings are append-only arrays of document numbers and term frequencies,
+    about five bytes per term of a document. Removed documents are only marked,
+    their postings stay until the index is rebuilt on the next start.
+    """
+
+    def __init__(self, weights: Dict[str, int]):
+        self.weights = weights
+        # Document number to key, None once removed
+        self.keys: List[Optional[str]] = []
+        self.docs: Dict[str, int] = {}
+        self.lengths = array("I")
+        self.postings: Dict[str, Tuple[array, array]] = {}
+        # Sorted vocabulary for prefix matching, new terms are in `tail`
+        self.terms: List[str] = []
+        self.tail: List[str] = []
+        self.sorted = True
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def add(self, key: str, fields: Dict[str, str]):
+        """Indexes the document `key`, replacing what was indexed for it before."""
+        self.remove(key)
+        tf: Counter = Counter()
+        for field, text in fields.items():
+            for token in tokenize(text):
+                tf[token] += self.weights.get(field, 1)
+        if not tf:
+            return
+        doc = len(self.keys)
+        self.keys.append(key)
+        self.docs[key] = doc
+        length = sum(tf.values())
+        self.lengths.append(length)
+        self.total_length += length
+        for term, freq in tf.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = (array("I"), array("B"))
+                self.tail.append(term)
+                self.sorted = False
+            postings[0].append(doc)
+            postings[1].append(min(freq, 255))
+
+    def remove(self, key: str):
+        doc = self.docs.pop(key, None)
+        if doc is not None:
+            self.keys[doc] = None
+            self.total_length -= self.lengths[doc]
+
+    def expand(self, token: str) -> Dict[str, float]:
+        """Index terms matching a query token, with their weight."""
+        terms = {}
+        if not self.sorted:
+            # Only the tail is sorted per query, the vocabulary once per TAIL_SIZE
+            # new terms, or once after loading
+            self.tail.sort()
+            if len(self.tail) > TAIL_SIZE:
+                self.terms += self.tail
+                self.terms.sort()
+                self.tail = []
+            self.sorted = True
+        prefixed = []
+        for vocabulary in (self.terms, self.tail):
+            start = bisect_left(vocabulary, token)
+            for term in vocabulary[start : start + MAX_EXPANSIONS]:
+                if not term.startswith(token):
+                    break
+                prefixed.append(term)
+        for term in sorted(prefixed)[:MAX_EXPANSIONS]:
+            terms[term] = PREFIX_WEIGHT
+        if len(token) >= 4:
+            for term in edits(token):
+                if term in self.postings:
+                    terms.setdefault(term, FUZZY_WEIGHT)
+        if token in self.postings:
+            terms[token] = 1.0
+        return terms
+
+    def search(self, query: str, limit: int) -> List[str]:
+        """Keys of the best `limit` documents matching any query token."""
+        weights: Dict[str, float] = {}
+        for token in tokenize(query):
+            for term, weight in self.expand(token).items():
+                weights[term] = max(weights.get(term, 0.0), weight)
+        if not weights or not self.docs:
+            return []
+        n = len(self.docs)
+        avg = self.total_length / n
+        lengths = self.lengths
+        scores: Dict[int, float] = {}
+        # Rarest terms first, so common ones can be restricted to their results
+        for term in sorted(weights, key=lambda t: len(self.postings[t][0])):
+            docs, tfs = self.postings[term]
+            df = len(docs)
+            idf = math.log(1 + max(n - df + 0.5, 0.5) / (df + 0.5)) * weights[term]
+            if df <= PRUNE_AT:
+                matches = zip(docs, tfs)
+            elif scores:
+                # Both sides are sorted, walk whichever part is shorter
+                lo = bisect_left(docs, min(scores))
+                if df - lo < len(scores) * 8:
+                    matches = [
+                        (doc, tf)
+                        for doc, tf in zip(docs[lo:], tfs[lo:])
+                        if doc in scores
+                    ]
+                else:
+                    matches = []
+                    for doc in scores:
+                        i = bisect_left(docs, doc, lo)
+                        if i < df and docs[i] == doc:
+                            matches.append((doc, tfs[i]))
+            else:
+                # Only common terms, rank the most recent documents using them
+                matches = zip(docs[-PRUNE_AT:], tfs[-PRUNE_AT:])
+            for doc, tf in matches:
+                norm = K1 * (1 - B + B * lengths[doc] / avg)
+                scores[doc] = scores.get(doc, 0.0) + idf * tf * (K1 + 1) / (tf + norm)
+        keys = self.keys
+        best = heapq.nlargest(
+            limit,
+            (item for item in scores.items() if keys[item[0]] is not None),
+            key=lambda item: item[1],
+        )
+        return [keys[doc] for doc, _ in best]
+
+
+def ranked(ids: List[str]) -> List[dict]:
+    """Stages keeping the documents in `ids`, in that order."""
+    ids = [*map(PydanticObjectId, ids)]
+    return [
+        {"$match": {"_id": {"$in": ids}}},
+        {"$addFields": {"_rank": {"$indexOfArray": [ids, "$_id"]}}},
+        {"$sort": {"_rank": 1}},
+    ]
+
+
+class AtlasSearch:
+    """Search with Atlas Search indexes named after the collections."""
+
+    async def stages(
+        self, kind: str, query: str, docs: FindMany, pipe: List[dict], window: int
+    ) -> Tuple[List[dict], Optional[int]]:
+        search = {
+            "$search": {
+                "index": kind,
+                "text": {"query": query, "path": [*FIELDS[kind]], "fuzzy": {}},
+            }
+        }
+        return [search, *pipe], None
+
+    async def add(self, kind: str, doc: Any):
+        pass
+
+    async def remove(self, kind: str, id: str):
+        pass
+
+    async def listen(self):
+        pass
+
+
+class LocalSearch:
+    """
+    In-process search, every worker holds the index of all searchable
+    documents. Changes are applied by every worker through the broadcast.
+    """
+
+    CHANNEL = "search"
+
+    def __init__(self, broadcast: Broadcast, max_hits: int, max_filtered_hits: int):
+        self.broadcast = broadcast
+        self.max_hits = max_hits
+        # Filters are applied by the database, to more matches so fewer are lost
+        self.max_filtered_hits = max_filtered_hits
+        self.indexes = {
+            kind: InvertedIndex(weights) for kind, weights in FIELDS.items()
+        }
+        for kind, index in self.indexes.items():
+            metrics.gauge(f"search.{kind}", index.__len__)
+
+    async def stages(
+        self, kind: str, query: str, docs: FindMany, pipe: List[dict], window: int
+    ) -> Tuple[List[dict], Optional[int]]:
+        """
+        Stages replacing the filters `pipe` of `docs` by the documents matching
+        the query, and their count. When the results keep their relevance order
+        `window` is the number of them paging may reach, else 0.
+        """
+        metrics.inc("search.queries")
+        filtered = bool(pipe or docs.get_filter_query())
+        hits = self.indexes[kind].search(
+            query, self.max_filtered_hits if filtered else self.max_hits
+        )
+        if filtered and hits:
+            # Only ids are read, ranking them in the database scans the hits per match
+            ids = [*map(PydanticObjectId, hits)]
+            stages = [
+                {"$match": {"_id": {"$in": ids}}},
+                *pipe,
+                {"$project": {"_id": 1}},
+            ]
+            kept = {str(doc["_id"]) for doc in await docs.aggregate(stages).to_list()}
+            hits = [id for id in hits if id in kept]
+        if window:
+            return ranked(hits[:window]), len(hits)
+        return [{"$match": {"_id": {"$in": [*map(PydanticObjectId, hits)]}}}], len(hits)
+
+    async def add(self, kind: str, doc: Any):
+        id = str(doc.id if isinstance(doc, BaseModel) else doc["_id"])
+        message = {"kind": kind, "id": id, "fields": text_fields(kind, doc)}
+        await self.broadcast.publish(channel=self.CHANNEL, message=json.dumps(message))
+
+    async def remove(self, kind: str, id: str):
+        message = {"kind": kind, "id": id, "fields": None}
+        await self.broadcast.publish(channel=self.CHANNEL, message=json.dumps(message))
+
+    def apply(self, message: str):
+        change = json.loads(message)
+        index = self.indexes[change["kind"]]
+        if change["fields"] is None:
+            index.remove(change["id"])
+        else:
+            index.add(change["id"], change["fields"])
+
+    async def load(self):
+        """Indexes every stored document of the searchable collections."""
+        for kind, model in MODELS.items():
+            projection = {path: 1 for path in FIELDS[kind]}
+            cursor = model.get_motor_collection().find({}, projection)
+            loaded = 0
+            async for doc in cursor:
+                self.indexes[kind].add(str(doc["_id"]), text_fields(kind, doc))
+                loaded += 1
+                if loaded % 1000 == 0:
+                    await asyncio.sleep(0)
+
+    def loaded(self, loader: asyncio.Task):
+        if not loader.cancelled() and loader.exception():
+            log.error("Failed to load the search index", exc_info=loader.exception())
+
+    async def listen(self):
+        """Loads the index and applies published changes. Runs for the app lifetime."""
+        async with self.broadcast.subscribe(channel=self.CHANNEL) as subscriber:
+            # Subscribed first so nothing published while loading is missed
+            loader = asyncio.create_task(self.load())
+            loader.add_done_callback(self.loaded)
+            try:
+                async for event in subscriber:
+                    self.apply(event.message)
+            finally:
+                loader.cancel()